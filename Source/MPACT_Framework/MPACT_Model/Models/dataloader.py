@@ -3,13 +3,27 @@ import random
 import os
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torch.utils.data import Dataset
-import albumentations as A
-from albumentations.pytorch import ToTensorV2
 from PIL import Image
 import matplotlib.pyplot as plt
 import json
 import itertools
+import zlib
+import hashlib
+import tempfile
+from multiprocessing import shared_memory, resource_tracker
+from tqdm import tqdm
+from sample_encoding import sample_background, encode_sample, fill_sample, decode_sample
+from sample_labels import read_json_labes, LabelIndex, read_labels, get_filename_key
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # The shared-memory cache needs it, the rest works without
+
+sample_shape = (64, 64, 5) # Shape of the samples in sparse shards, which only store their pairs
+dataset_index_version = 2 # Bumped when the arrays of the dataset index change
+shared_memory_dir = "/dev/shm" # Where Linux lists the named shared-memory blocks
 
 def one_hot_encoding(floats_list):
     # Generate all possible orderings
@@ -53,48 +67,251 @@ def visualize_7channels(img: np.ndarray):
     plt.tight_layout()
     plt.show()
 
-def read_json_labes(filename):
-    with open(filename, 'r') as f:
-        data = json.load(f)        
-    processed_data = {}
-    for key, value in data.items():
-        processed_data[key] = (value['wg'], value['wgr'], value['wi'], value['wc'])    
-    return processed_data
+class BatchAugmentation:
+    """Random rotations of 90, 180, 270 or 360 degrees, each jittered by up to +-jitter degrees, and
+    random horizontal/vertical flips, applied to a whole (batch, channels, height, width) tensor.
+
+    Rotation and flips are folded into one affine matrix per sample, applied with a single
+    grid_sample over the batch. The base sampling grid of each image size is built once and reused.
+    """
+    def __init__(self, jitter=10.0):
+        self.jitter = jitter
+        self.base_grids = {}
+
+    def base_grid(self, images):
+        key = (images.shape[-2:], images.device, images.dtype)
+        if key not in self.base_grids:
+            identity = torch.eye(2, 3, device=images.device, dtype=images.dtype).unsqueeze(0)
+            grid = F.affine_grid(identity, (1, 1) + tuple(images.shape[-2:]), align_corners=False)
+            self.base_grids[key] = torch.cat((grid, torch.ones_like(grid[..., :1])), dim=-1).flatten(1, 2)
+        return self.base_grids[key]
+
+    def __call__(self, images, seed=None):
+        """Augmented copy of images, drawn from a generator seeded with seed when one is given."""
+        generator = None
+        if seed is not None:
+            generator = torch.Generator(device=images.device)
+            generator.manual_seed(seed)
+        count = images.size(0)
+        options = dict(generator=generator, device=images.device)
+        quarter = torch.randint(1, 5, (count,), **options).to(images.dtype)
+        jitter = (torch.rand(count, **options, dtype=images.dtype) * 2 - 1) * self.jitter
+        angle = torch.deg2rad(quarter * 90 + jitter)
+        flip_x = torch.randint(0, 2, (count,), **options).to(images.dtype) * 2 - 1
+        flip_y = torch.randint(0, 2, (count,), **options).to(images.dtype) * 2 - 1
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        theta = torch.stack((
+            torch.stack((cos * flip_x, -sin * flip_y, torch.zeros_like(cos)), dim=1),
+            torch.stack((sin * flip_x, cos * flip_y, torch.zeros_like(cos)), dim=1)), dim=1)
+        grid = (self.base_grid(images) @ theta.transpose(1, 2)).view(count, images.size(2), images.size(3), 2)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+
+def data_fingerprint(path):
+    """Size and modification time of what the dataset index is built from.
+
+    These are the shard indexes when the data is packed. Otherwise they are the image directory,
+    whose time changes when samples are added or removed, and the label files.
+    """
+    shards_path = os.path.join(path, "Shards")
+    if os.path.isdir(shards_path):
+        names = sorted(glob.glob(os.path.join(shards_path, "shard_*_index.npy")))
+    else:
+        names = [os.path.join(path, name) for name in ("SyntheticData", "labels.npy", "labels.json")]
+    stats = [(os.path.relpath(name, path), os.stat(name)) for name in names if os.path.exists(name)]
+    return json.dumps({"version": dataset_index_version, "files": [[name, stat.st_size, stat.st_mtime_ns] for name, stat in stats]})
+
+def build_dataset_index(path):
+    """Arrays describing every sample: key, key hash, label, and the file holding the image with its
+    row there, or for sparse shards the start and stop of its pairs."""
+    shards_path = os.path.join(path, "Shards")
+    if os.path.isdir(shards_path):
+        index_names = sorted(glob.glob(os.path.join(shards_path, "shard_*_index.npy")))
+        shard_indexes = [np.load(name) for name in index_names]
+        sparse = ['start' in index.dtype.names for index in shard_indexes]
+        source_names = [os.path.relpath(name[:-len("_index.npy")] + ("_pairs.npy" if pairs else ".npy"), path) for name, pairs in zip(index_names, sparse)]
+        keys = np.concatenate([index['key'] for index in shard_indexes])
+        labels = np.concatenate([index['weights'] for index in shard_indexes])
+        sources = np.concatenate([np.full(len(index), shard, np.int32) for shard, index in enumerate(shard_indexes)])
+        rows = np.concatenate([index['start'] if pairs else np.arange(len(index)) for index, pairs in zip(shard_indexes, sparse)])
+        stops = np.concatenate([index['stop'] if pairs else np.arange(1, len(index) + 1) for index, pairs in zip(shard_indexes, sparse)])
+    else:
+        img_names = sorted(glob.glob(os.path.join(path, "SyntheticData") + "/*.*"))
+        label_lookup = read_labels(path)
+        source_names = [os.path.relpath(name, path) for name in img_names]
+        keys = np.array([get_filename_key(name) for name in img_names])
+        labels = np.array([label_lookup[key] for key in keys], np.float32).reshape(-1, 4)
+        sources = np.arange(len(img_names), dtype=np.int32)
+        rows = np.zeros(len(img_names), np.int64)
+        stops = np.ones(len(img_names), np.int64)
+    hashes = np.array([zlib.crc32(key.encode()) for key in keys], np.uint32)
+    return {'keys': keys, 'hashes': hashes, 'labels': labels, 'sources': sources, 'rows': rows, 'stops': stops, 'source_names': np.array(source_names)}
+
+def load_dataset_index(path):
+    """Dataset index saved in path, rebuilt first when it is missing or the data changed since."""
+    index_path = os.path.join(path, "dataset_index.npz")
+    fingerprint = data_fingerprint(path)
+    if os.path.exists(index_path):
+        with np.load(index_path) as saved:
+            index = dict(saved)
+        if str(index.pop('fingerprint')) == fingerprint:
+            return index
+    index = build_dataset_index(path)
+    # Written aside under a name of this process and renamed, so concurrent runs never read a
+    # partial index nor write into each other's
+    tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+    with open(tmp_path, "wb") as index_file:
+        np.savez(index_file, fingerprint=np.array(fingerprint), **index)
+    os.replace(tmp_path, index_path)
+    return index
+
+def split_rows(hashes, mode, val_fraction):
+    """Rows of the val split, or of the train split for any other mode.
+
+    A sample's side depends only on the hash of its key, so it keeps its side however the files
+    are ordered or how many samples are added.
+    """
+    in_val = hashes.astype(np.float64) / 2**32 < val_fraction
+    return np.flatnonzero(in_val if mode == "val" else ~in_val)
+
+def unlink_shared_memory(name):
+    """Removes the named shared-memory block, if it exists. Processes attached to it keep their mapping."""
+    try:
+        memory = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return
+    memory.close()
+    memory.unlink()
 
-def get_filename_key(path):
-    base_name = os.path.basename(path)
-    return os.path.splitext(base_name)[0]
+class SharedImages:
+    """Decoded float16 images of a whole dataset in one named shared-memory block.
+
+    The first process that needs the block creates and fills it. DataLoader workers and concurrent
+    training runs on the same data attach to it rather than decoding their own copy. The block
+    outlives the processes, so later runs reuse it. Its name is prefix_fingerprint: changed data gets
+    a new block and the blocks of the same prefix are then removed. release frees it explicitly.
+    """
+    header_bytes = 64 # The first byte is set once the block is filled
+
+    def __init__(self, name, count, shape):
+        self.name = name
+        self.count = count
+        self.shape = tuple(shape)
+        self.memory = None
+        self.images = None
+
+    def attach(self, fill=None):
+        """Maps the block, filling it with fill(images) first when no process has done so yet."""
+        if fcntl is None:
+            raise RuntimeError("The shared-memory dataset cache needs a POSIX system")
+        size = self.header_bytes + self.count * int(np.prod(self.shape)) * np.dtype(np.float16).itemsize
+        # Node-wide lock, one process fills the block while the others wait for it
+        with open(os.path.join(tempfile.gettempdir(), self.name + ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                memory = shared_memory.SharedMemory(self.name)
+            except FileNotFoundError:
+                self.remove_stale()
+                memory = shared_memory.SharedMemory(self.name, create=True, size=size)
+            # Otherwise the resource tracker unlinks the block when this process exits
+            resource_tracker.unregister(memory._name, "shared_memory")
+            images = np.ndarray((self.count,) + self.shape, np.float16, buffer=memory.buf, offset=self.header_bytes)
+            if memory.buf[0] != 1:
+                if fill is None:
+                    raise RuntimeError("The shared dataset cache %s has not been filled" % self.name)
+                fill(images)
+                memory.buf[0] = 1
+        self.memory, self.images = memory, images
+        return images
+
+    def remove_stale(self):
+        """Unlinks the blocks of the same prefix, left by earlier versions of the data."""
+        prefix = self.name.rsplit("_", 1)[0] + "_"
+        for block in glob.glob(os.path.join(shared_memory_dir, prefix + "*")):
+            if os.path.basename(block) != self.name:
+                unlink_shared_memory(os.path.basename(block))
+
+    def release(self):
+        """Unlinks the block so its memory is freed once every attached process has exited. The next
+        run that needs it fills a new one."""
+        unlink_shared_memory(self.name)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.attach()
+        return self.images[index]
+
+    def __getstate__(self):
+        # Workers attach by name rather than receiving a copy of the images
+        return {'name': self.name, 'count': self.count, 'shape': self.shape, 'memory': None, 'images': None}
 
 class ImageDataset(Dataset):
-    def __init__(self, mode="train", start=0, end=1):
+    """Samples of the dataset in path, split by key hash or, with start/end, by index order.
+
+    Index order is the sorted file names, or the shard order when the data is packed in Shards/.
+    With in_memory, the whole dataset is decoded once into SharedImages and samples stay float16
+    until the batch is augmented.
+    """
+    def __init__(self, mode="train", start=None, end=None, val_fraction=0.25, path="./PATH-TO-DATA", in_memory=False):
         self.mode = mode
-        self.imgs = sorted(glob.glob(os.path.join("./PATH-TO-DATA/SyntheticData") + "/*.*"))[start:end]
-        self.labels = read_json_labes("./PATH-TO-DATA/labels.json") #(goal, group, interaction, connection)
+        self.path = path
+        index = load_dataset_index(path)
+        if start is None and end is None:
+            rows = split_rows(index['hashes'], mode, val_fraction)
+        else:
+            rows = np.arange(len(index['keys']))[start:end]
+        self.source_names = index['source_names']
+        self.sources = index['sources'][rows]
+        self.rows = index['rows'][rows]
+        self.stops = index['stops'][rows]
+        self.labels = index['labels'][rows] #(goal, group, interaction, connection)
+        self.index_rows = rows
+        self.mapped = {}
+        self.shared = None
+        if in_memory:
+            # Every sample of the index, so the train and val splits share one block
+            everything = ImageDataset(start=0, end=None, path=path)
+            name = "mpact_%s_%s" % (hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8],
+                                    hashlib.sha1(data_fingerprint(path).encode()).hexdigest()[:8])
+            self.shared = SharedImages(name, len(everything), everything.decode(0).shape)
+            self.shared.attach(everything.decode_all)
 
-    def __getitem__(self, index):
-        img_name = self.imgs[index % len(self.imgs)]
-        img_temp = np.load(img_name)
-        img_np = img_temp[list(img_temp.keys())[0]].astype(np.float32)
-
-        if self.mode == "train":
-            randomDegreeRange = random.choice([(80,100), (170,190), (260,280), (350,370)])
-            current_transforms = A.Compose([
-                A.Rotate(limit=randomDegreeRange, always_apply=True),
-                A.HorizontalFlip(p=0.5),
-                A.VerticalFlip(p=0.5),
-                ToTensorV2()
-            ])
+    def decode(self, index):
+        """Image as stored, before any cast."""
+        source = self.source_names[self.sources[index]]
+        if source.endswith(".npy"):
+            # Shards are memory-mapped on first use in each worker, a sample is a slice of the mapping
+            if source not in self.mapped:
+                self.mapped[source] = np.load(os.path.join(self.path, source), mmap_mode='r')
+            if source.endswith("_pairs.npy"):
+                pairs = self.mapped[source][self.rows[index]:self.stops[index]]
+                img_np = fill_sample(sample_shape, sample_background, pairs['index'], pairs['value'])
+            else:
+                img_np = self.mapped[source][self.rows[index]]
         else:
-            current_transforms = A.Compose([
-                ToTensorV2()
-            ])
+            img_np = decode_sample(np.load(os.path.join(self.path, source)))
+        return img_np
 
-        transformed = current_transforms(image=img_np)
-        img = transformed['image']
+    def decode_all(self, images):
+        for index in tqdm(range(len(self)), desc="Decoding the dataset into shared memory", leave=False):
+            images[index] = self.decode(index)
 
-        label_key = get_filename_key(img_name)
-        label = self.labels[label_key]
+    def load(self, index):
+        """Image, float16 from the shared cache and float32 otherwise, and its (goal, group, interaction, connection) label."""
+        index = index % len(self.labels)
+        if self.shared is not None:
+            return self.shared[self.index_rows[index]], self.labels[index]
+        return self.decode(index).astype(np.float32), self.labels[index]
+
+    def __getitem__(self, index):
+        # Training augmentation is applied per batch by BatchAugmentation
+        img_np, label = self.load(index)
+        img = torch.from_numpy(img_np.transpose(2, 0, 1))
         return img, torch.tensor(label, dtype=torch.float32)
 
     def __len__(self):
-        return len(self.imgs)
\ No newline at end of file
+        return len(self.labels)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['mapped'] = {}
+        return state
\ No newline at end of file
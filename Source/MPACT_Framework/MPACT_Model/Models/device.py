@@ -0,0 +1,121 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+def select_device(name=None):
+    """Device named by name or the MPACT_DEVICE environment variable, otherwise cuda when available and cpu if not.
+
+    Under torchrun each process takes the cuda device of its LOCAL_RANK.
+    """
+    name = name or os.environ.get("MPACT_DEVICE")
+    if name:
+        return torch.device(name)
+    if torch.cuda.is_available():
+        return torch.device('cuda', int(os.environ.get("LOCAL_RANK", 0)))
+    return torch.device('cpu')
+
+def configure_threads(intra_op=None, inter_op=None):
+    """Sets the intra-op and inter-op thread counts, taken from MPACT_THREADS and MPACT_INTEROP_THREADS when not given.
+
+    Counts left unset keep torch's defaults. The inter-op count can only be set before torch runs
+    any parallel work, later attempts are ignored.
+    """
+    intra_op = intra_op or int(os.environ.get("MPACT_THREADS", 0))
+    inter_op = inter_op or int(os.environ.get("MPACT_INTEROP_THREADS", 0))
+    if intra_op:
+        torch.set_num_threads(intra_op)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            pass
+
+def cpu_supports_bf16():
+    """Whether oneDNN has fast bf16 kernels on this CPU. Without them, bf16 autocast is slower than fp32."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+def autocast_dtype(device):
+    """fp16 on cuda, bf16 on CPUs that support it, None where mixed precision does not pay off."""
+    if device.type == 'cuda':
+        return torch.float16
+    if device.type == 'cpu' and cpu_supports_bf16():
+        return torch.bfloat16
+    return None
+
+def autocast(device, enabled=True):
+    """Autocast context for device, a no-op when disabled or when the device has no fast mixed precision."""
+    dtype = autocast_dtype(device)
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=enabled and dtype is not None)
+
+def grad_scaler(device):
+    """Gradient scaler for fp16 on cuda. On any other device it is disabled and passes losses and steps through,
+    bf16 keeps the fp32 exponent range and needs no scaling."""
+    return torch.amp.GradScaler(device.type, enabled=device.type == 'cuda')
+
+def prepare_model(model, device):
+    """Model moved to device in channels_last, the layout the CPU and cuda convolution kernels are fastest in."""
+    return model.to(device, memory_format=torch.channels_last)
+
+def prepare_inputs(inputs, device):
+    """(batch, channels, height, width) inputs moved to device in channels_last."""
+    return inputs.to(device, non_blocking=True, memory_format=torch.channels_last)
+
+def load_checkpoint(path, device):
+    """Checkpoint loaded onto device, wherever it was saved from."""
+    return torch.load(path, map_location=device)
+
+def mixed_precision_error(model, inputs, device):
+    """Largest absolute difference between the outputs of model in fp32 and under autocast on inputs."""
+    with torch.no_grad():
+        reference = model(inputs).float()
+        with autocast(device):
+            mixed = model(inputs).float()
+    return (mixed - reference).abs().max().item()
+
+def init_distributed(device):
+    """Joins the process group when started by torchrun with more than one process and returns (rank, world size),
+    (0, 1) otherwise.
+
+    gloo is used on CPU and nccl on cuda. torchrun --nproc-per-node runs the processes on one machine,
+    adding --nnodes and --rdzv-endpoint spreads them over several.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1
+    if device.type == 'cuda':
+        # Otherwise every rank's communicator starts on the current device, cuda:0
+        torch.cuda.set_device(device)
+    dist.init_process_group(backend="nccl" if device.type == 'cuda' else "gloo")
+    return dist.get_rank(), world_size
+
+def wrap_distributed(model, device):
+    """model in DistributedDataParallel when the process group is up, model itself otherwise."""
+    if not dist.is_initialized():
+        return model
+    return DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+
+def unwrap(model):
+    """The model inside DistributedDataParallel, so checkpoints keep their keys whichever way they were trained."""
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+def synchronize(device):
+    """Waits for the work queued on a cuda device, returns at once on any other device."""
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def barrier():
+    """Waits for every process to get here, returns at once when not distributed."""
+    if dist.is_initialized():
+        dist.barrier()
+
+def all_reduce_sum(values, device):
+    """values summed over every process, values themselves when not distributed."""
+    if not dist.is_initialized():
+        return list(values)
+    totals = torch.tensor(values, dtype=torch.float64, device=device if dist.get_backend() == 'nccl' else 'cpu')
+    dist.all_reduce(totals)
+    return totals.tolist()
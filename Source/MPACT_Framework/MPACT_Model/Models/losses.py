@@ -0,0 +1,51 @@
+import torch
+
+def compute_loss(reg_outputs, ground_truth_weights, criterionDominant, criterionReg, importance_second):
+    """Loss of a batch, and the targets and decoded weights that count_correct needs."""
+    truth_class = torch.argmax(ground_truth_weights[:, 0:3], 1)
+    top2_values, top2_indices = torch.topk(ground_truth_weights[:, 0:3], 2, dim=1)
+    second_class = top2_indices[:, 1]
+
+    class_loss = criterionDominant(reg_outputs[:,0:3], truth_class)
+    class_loss_2 = criterionDominant(reg_outputs[:,0:3], second_class)
+
+    v1 = reg_outputs[:, 3]
+    v2 = reg_outputs[:, 4]
+
+    values, indices = torch.topk(reg_outputs[:, 0:3], 3, dim=1)
+    pred_first = indices[:, 0]
+    pred_second = indices[:, 1]
+    pred_third = indices[:, 2]
+
+    w_a = (1 + v1 + v2) / 3.0
+    w_b = w_a - v1
+    w_c = w_a - v2
+    w_conn = reg_outputs[:, 5]
+
+    rows = torch.arange(ground_truth_weights.size(0), device=ground_truth_weights.device)
+    reg_loss_a = criterionReg(w_a, ground_truth_weights[rows, pred_first])
+    reg_loss_b = criterionReg(w_b, ground_truth_weights[rows, pred_second])
+    reg_loss_c = criterionReg(w_c, ground_truth_weights[rows, pred_third])
+    reg_loss_conn = criterionReg(w_conn, ground_truth_weights[:, 3])
+    total_loss = ((1 - importance_second) * class_loss + importance_second * class_loss_2) + reg_loss_a + reg_loss_b + reg_loss_c + reg_loss_conn
+
+    decoded = {'truth_class': truth_class, 'second_class': second_class, 'pred_first': pred_first, 'pred_second': pred_second,
+               'pred_third': pred_third, 'w_a': w_a, 'w_b': w_b, 'w_c': w_c, 'w_conn': w_conn}
+    return total_loss, decoded
+
+def count_correct(reg_outputs, ground_truth_weights, decoded, tolerance):
+    """Correct first class, second class, goal, group, interact and connect predictions of a batch.
+
+    Counted on the device, without waiting for it, so they can be summed over the epoch and read once.
+    """
+    rows = torch.arange(ground_truth_weights.size(0), device=ground_truth_weights.device)
+    predicted = torch.argmax(reg_outputs[:,0:3].data, 1)
+    top2_values, top2_indices = torch.topk(reg_outputs[:,0:3], 2, dim=1)
+    predicted_second = top2_indices[:, 1]
+    return torch.stack((
+        (predicted == decoded['truth_class']).sum(),
+        (predicted_second == decoded['second_class']).sum(),
+        (torch.abs(decoded['w_a'] - ground_truth_weights[rows, decoded['pred_first']]) <= tolerance).sum(),
+        (torch.abs(decoded['w_b'] - ground_truth_weights[rows, decoded['pred_second']]) <= tolerance).sum(),
+        (torch.abs(decoded['w_c'] - ground_truth_weights[rows, decoded['pred_third']]) <= tolerance).sum(),
+        (torch.abs(decoded['w_conn'] - ground_truth_weights[:, 3]) <= tolerance).sum()))
@@ -86,7 +86,8 @@ class CNN_Class_Reg(nn.Module):
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
-        x = x.view(-1, 128 * 8 * 8)
+        # reshape rather than view, channels_last activations are not contiguous
+        x = x.reshape(-1, 128 * 8 * 8)
         x = self.fc1(x)
         x = self.fc2(x)
         x = self.fc3(x)
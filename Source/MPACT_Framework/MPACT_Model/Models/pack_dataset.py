@@ -0,0 +1,65 @@
+import argparse
+import glob
+import os
+import numpy as np
+from tqdm import tqdm
+from sample_labels import read_labels, get_filename_key
+from sample_encoding import decode_sample, encode_sample
+
+def write_shard(name, keys, weights, img_names, encoding="dense"):
+    """Writes the images and their (key, weights) rows as a shard that ImageDataset memory-maps.
+
+    Dense shards hold the images as one array. Sparse shards hold the (index, value) pairs of every
+    image back to back, and the index rows hold where each image's pairs start and stop.
+    """
+    fields = [('key', 'U%d' % max(len(key) for key in keys)), ('weights', np.float32, 4)]
+    if encoding == "dense":
+        data_name = name + ".npy"
+        first = decode_sample(np.load(img_names[0]))
+        images = np.lib.format.open_memmap(data_name + ".tmp", mode="w+", dtype=first.dtype, shape=(len(img_names),) + first.shape)
+        for row, img_name in enumerate(img_names):
+            images[row] = decode_sample(np.load(img_name))
+        images.flush()
+        del images
+    else:
+        data_name = name + "_pairs.npy"
+        samples = [encode_sample(decode_sample(np.load(img_name)), encoding) for img_name in img_names]
+        counts = [len(sample["indices"]) for sample in samples]
+        pairs = np.empty(sum(counts), dtype=[('index', samples[0]["indices"].dtype), ('value', samples[0]["values"].dtype)])
+        pairs['index'] = np.concatenate([sample["indices"] for sample in samples])
+        pairs['value'] = np.concatenate([sample["values"] for sample in samples])
+        with open(data_name + ".tmp", "wb") as pairs_file:
+            np.save(pairs_file, pairs)
+        fields += [('start', np.int64), ('stop', np.int64)]
+    index = np.empty(len(keys), dtype=fields)
+    index['key'] = keys
+    index['weights'] = weights
+    if encoding != "dense":
+        index['stop'] = np.cumsum(counts)
+        index['start'] = index['stop'] - counts
+    with open(name + "_index.npy.tmp", "wb") as index_file:
+        np.save(index_file, index)
+    # The index goes in last, so a shard whose index exists is complete
+    os.replace(data_name + ".tmp", data_name)
+    os.replace(name + "_index.npy.tmp", name + "_index.npy")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Packs the per-sample .npz images and their labels into memory-mappable shards.")
+    parser.add_argument("--data", default="./PATH-TO-DATA", help="directory holding SyntheticData/ and the labels")
+    parser.add_argument("--shard-size", type=int, default=65536, help="samples per shard")
+    parser.add_argument("--encoding", default="dense", choices=["dense", "sparse", "sparse_uint8"], help="how the shards store the images, see encode_sample")
+    args = parser.parse_args()
+
+    # Sorted like ImageDataset sorts the files, so start/end index the samples in the same order
+    img_names = sorted(glob.glob(os.path.join(args.data, "SyntheticData") + "/*.*"))
+    labels = read_labels(args.data)
+    shards_path = os.path.join(args.data, "Shards")
+    os.makedirs(shards_path, exist_ok=True)
+    # Shards of an earlier packing would otherwise be indexed along with the new ones
+    for name in glob.glob(os.path.join(shards_path, "shard_*")):
+        os.remove(name)
+
+    for shard, start in enumerate(tqdm(range(0, len(img_names), args.shard_size))):
+        names = img_names[start:start + args.shard_size]
+        keys = [get_filename_key(img_name) for img_name in names]
+        write_shard(os.path.join(shards_path, "shard_%05d" % shard), keys, [labels[key] for key in keys], names, args.encoding)
@@ -0,0 +1,36 @@
+import numpy as np
+
+sample_background = (0.5, 0.5, 0, 0, 0) # Value of the empty pixels of each channel
+
+def encode_sample(img, encoding):
+    """Arrays to save for img in the given encoding: "dense", "sparse" or "sparse_uint8".
+
+    The sparse encodings keep only the pixels that differ from their channel's background (0.5 for
+    the velocities, 0 otherwise) as flat indices and values. sparse_uint8 also rounds the values,
+    which lie in [0, 1], to multiples of 1/255, so a decoded value is off by at most 1/510.
+    """
+    if encoding == "dense":
+        return {"arr_0": img}
+    background = np.asarray(sample_background, dtype=img.dtype)
+    flat = img.reshape(-1)
+    indices = np.flatnonzero(img != background)
+    values = flat[indices]
+    if encoding == "sparse_uint8":
+        values = np.rint(np.clip(values.astype(np.float32), 0, 1) * 255).astype(np.uint8)
+    return {"indices": indices.astype(np.uint16 if flat.size <= 2 ** 16 else np.uint32), "values": values,
+            "shape": np.asarray(img.shape), "background": background}
+
+def fill_sample(shape, background, indices, values):
+    """Dense image of a sparse sample: the background with the values scattered at their indices."""
+    if values.dtype == np.uint8:
+        values = values * np.float32(1 / 255)
+    img = np.empty(tuple(shape), values.dtype)
+    img[...] = background
+    img.reshape(-1)[indices] = values
+    return img
+
+def decode_sample(data):
+    """Dense image of a loaded sample file, whichever encoding encode_sample wrote it in."""
+    if 'indices' not in data:
+        return data[list(data.keys())[0]]
+    return fill_sample(data['shape'], data['background'], data['indices'], data['values'])
@@ -0,0 +1,44 @@
+import os
+import json
+import numpy as np
+
+def read_json_labes(filename):
+    with open(filename, 'r') as f:
+        data = json.load(f)        
+    processed_data = {}
+    for key, value in data.items():
+        processed_data[key] = (value['wg'], value['wgr'], value['wi'], value['wc'])    
+    return processed_data
+
+class LabelIndex:
+    """Labels compiled by the synthetic generator into (key, weights) rows sorted by key.
+
+    The file is memory-mapped on first use in each worker instead of being parsed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.rows = None
+
+    def __getitem__(self, key):
+        if self.rows is None:
+            self.rows = np.load(self.filename, mmap_mode='r')
+        keys = self.rows['key']
+        row = np.searchsorted(keys, key)
+        if row == len(keys) or keys[row] != key:
+            raise KeyError(key)
+        return tuple(self.rows['weights'][row].tolist())
+
+    def __getstate__(self):
+        # Workers map the file themselves rather than receiving a copy of it
+        return {'filename': self.filename, 'rows': None}
+
+def read_labels(path):
+    """Label index next to the data when it has been compiled, labels.json otherwise."""
+    index_path = os.path.join(path, "labels.npy")
+    if os.path.exists(index_path):
+        return LabelIndex(index_path)
+    return read_json_labes(os.path.join(path, "labels.json"))
+
+def get_filename_key(path):
+    base_name = os.path.basename(path)
+    return os.path.splitext(base_name)[0]
@@ -0,0 +1,103 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.optim as optim
+from dataloader import BatchAugmentation
+from model import CNN_Class_Reg
+from device import prepare_model, prepare_inputs, mixed_precision_error, wrap_distributed, unwrap, all_reduce_sum, autocast, grad_scaler
+from losses import compute_loss, count_correct
+
+# Quick CPU checks of the training pieces, run from Models/ with python smoke_test.py, or with
+# torchrun --nproc-per-node 2 smoke_test.py to also check that the processes train in sync. Each
+# check fails with an AssertionError, and the script prints "smoke test passed" when all of them hold.
+
+autocast_tolerance = 0.02 # The tolerance inference.py uses, here scaled by the largest fp32 output when above 1
+
+def check_augmentation(batch=8):
+    """The augmentation keeps the batch shape and order, so the labels still match their images,
+    and without jitter every image comes out as one of its 8 rotations and flips."""
+    augment = BatchAugmentation()
+    # Image i is filled with i, a constant image stays constant under any rotation or flip
+    images = torch.arange(batch, dtype=torch.float32).view(-1, 1, 1, 1).expand(-1, 5, 64, 64).contiguous()
+    augmented = augment(images, seed=0)
+    assert augmented.shape == images.shape and augmented.dtype == images.dtype
+    assert torch.allclose(augmented.mean(dim=(1, 2, 3)), torch.arange(batch, dtype=torch.float32), atol=1e-4), \
+        "the augmentation mixed up the samples of the batch, their labels would no longer match"
+    assert torch.equal(augment(images, seed=0), augmented), "the same seed gave different augmentations"
+
+    images = torch.rand(batch, 5, 64, 64)
+    augmented = BatchAugmentation(jitter=0)(images, seed=1)
+    for image, result in zip(images, augmented):
+        candidates = [torch.rot90(flipped, k, dims=(1, 2)) for flipped in (image, image.flip(2)) for k in range(4)]
+        assert min((result - candidate).abs().max().item() for candidate in candidates) < 1e-4, \
+            "an unjittered augmentation is not a rotation or flip of its image"
+
+def check_mixed_precision(batch=8):
+    """channels_last gives the outputs of the contiguous layout, and bf16 autocast stays within
+    autocast_tolerance of fp32, forced on even where autocast would leave it off for speed."""
+    device = torch.device('cpu')
+    model = CNN_Class_Reg().eval()
+    inputs = torch.rand(batch, 5, 64, 64)
+    with torch.no_grad():
+        reference = model(inputs)
+        model = prepare_model(model, device)
+        inputs = prepare_inputs(inputs, device)
+        assert torch.allclose(model(inputs), reference, atol=1e-5), "channels_last changed the outputs"
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+            mixed = model(inputs).float()
+    scale = max(1.0, reference.abs().max().item())
+    assert (mixed - reference).abs().max().item() <= autocast_tolerance * scale, "bf16 autocast is off from fp32"
+    assert mixed_precision_error(model, inputs, device) <= autocast_tolerance * scale
+
+def check_training_step(batch=8, tolerance=0.1, importance_second=0.3):
+    """One step of the train.py loop on a DistributedDataParallel model with gloo, in a group of the
+    processes torchrun started or of this one process: the loss is finite, the weights change and
+    stay the same in every process, and the device-side counts are sane."""
+    device = torch.device('cpu')
+    if "WORLD_SIZE" in os.environ:
+        dist.init_process_group(backend="gloo")
+    else:
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29512")
+        dist.init_process_group(backend="gloo", rank=0, world_size=1)
+    world_size = dist.get_world_size()
+    try:
+        model = wrap_distributed(prepare_model(CNN_Class_Reg(), device), device)
+        assert unwrap(model) is not model, "the model was not wrapped in DistributedDataParallel"
+        optimizer = optim.AdamW(model.parameters(), lr=0.0005, weight_decay=0.0001)
+        scaler = grad_scaler(device)
+        before = [parameter.detach().clone() for parameter in model.parameters()]
+
+        # Every process trains on its own batch, as with the DistributedSampler
+        generator = torch.Generator().manual_seed(dist.get_rank())
+        inputs = prepare_inputs(torch.rand(batch, 5, 64, 64, generator=generator), device)
+        ground_truth_weights = torch.rand(batch, 4, generator=generator)
+        inputs = BatchAugmentation()(inputs, seed=0).contiguous(memory_format=torch.channels_last)
+        model.train()
+        optimizer.zero_grad(set_to_none=True)
+        with autocast(device):
+            reg_outputs = model(inputs)
+            total_loss, decoded = compute_loss(reg_outputs, ground_truth_weights, nn.CrossEntropyLoss(), nn.L1Loss(), importance_second)
+        scaler.scale(total_loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        assert torch.isfinite(total_loss).item(), "the training loss is not finite"
+        assert any(not torch.equal(old, new) for old, new in zip(before, model.parameters())), "the step left the weights unchanged"
+        # The gradients are averaged over the processes, so every process takes the same step
+        checksum = sum(parameter.detach().double().sum().item() for parameter in model.parameters())
+        assert all_reduce_sum([checksum], device)[0] == checksum * world_size, "the processes' weights drifted apart"
+
+        correct = count_correct(reg_outputs.detach(), ground_truth_weights, decoded, tolerance)
+        assert correct.shape == (6,) and bool(((correct >= 0) & (correct <= batch)).all())
+        summed = all_reduce_sum(correct.tolist() + [batch], device)
+        assert summed[-1] == batch * world_size and all(0 <= count <= summed[-1] for count in summed[:-1])
+    finally:
+        dist.destroy_process_group()
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    check_augmentation()
+    check_mixed_precision()
+    check_training_step()
+    print("smoke test passed")
@@ -6,10 +6,12 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler, Subset
 from dataloader import *
 from model import *
 from utils import *
+from device import *
+from losses import *
 
 def worker_init_fn(worker_id):
     worker_seed = (torch.initial_seed() + worker_id) % 2**32
@@ -31,14 +33,20 @@ if __name__ ==  '__main__':
     start_epoch = 0
     tolerance = 0.1
     importance_second = 0.3
-
-    # Set device
-    device = torch.device('cuda')
+    data_path = "./PATH-TO-DATA"
+    in_memory = False # Decode the dataset once into shared memory, attached by the workers and concurrent runs (POSIX only)
+    keep_in_memory = True # Leave the shared-memory dataset for later runs on the same data instead of freeing it at the end
+    log_interval = 50 # Steps between progress bar loss updates, each one waits for the device
+
+    # Set device, one process per device when started with torchrun
+    device = select_device()
+    configure_threads()
+    rank, world_size = init_distributed(device)
     torch.backends.cudnn.benchmark = True
-    scaler = torch.cuda.amp.GradScaler()
+    scaler = grad_scaler(device)
 
     # Initialize the models
-    model = CNN_Class_Reg().to(device)
+    model = prepare_model(CNN_Class_Reg(), device)
 
     # Define the loss function and optimizer
     criterionDominant = nn.CrossEntropyLoss()
@@ -47,157 +55,119 @@ if __name__ ==  '__main__':
     scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.9, patience=10, verbose=True)
 
     if resume_train:
-        checkpoint = torch.load('output/saved_models/model_epoch_25.pt')
+        checkpoint = load_checkpoint('output/saved_models/model_epoch_25.pt', device)
         # Load the saved model and optimizer states
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_reg_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_reg_state_dict'])
         start_epoch = 26
-    else:
+    elif rank == 0:
         params = (f"LR_AC: {learning_rate}, BS: {batch_size}, L1: {lambda_l1}, WD: {weight_decay}")
         with open("output/saved_info/info.txt", "a") as f:
                 f.write(params + "\n")
 
-    # Data augmentation and normalization for training
+    # Synchronises the gradients over the processes when distributed
+    model = wrap_distributed(model, device)
+
+    # Data augmentation for training, applied per batch on the device
+    augment = BatchAugmentation()
+    # Rank 0 alone rebuilds a missing or stale dataset index, the other ranks wait and load it
+    if rank == 0:
+        load_dataset_index(data_path)
+    barrier()
+    train_dataset = ImageDataset(mode="train", path=data_path, in_memory=in_memory)
+    val_dataset = ImageDataset(mode="val", path=data_path, in_memory=in_memory)
+    # Each process trains on its own share of every epoch and validates an exclusive slice,
+    # so the summed validation counts cover every sample once
+    train_sampler = DistributedSampler(train_dataset) if world_size > 1 else None
+    val_dataset = Subset(val_dataset, range(rank, len(val_dataset), world_size)) if world_size > 1 else val_dataset
     train_loader = DataLoader(
-        ImageDataset(mode="train", start=0, end=112500),
+        train_dataset,
         batch_size=batch_size,
-        shuffle=True,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
         num_workers=4,
-        pin_memory=True,
+        pin_memory=device.type == 'cuda',
         worker_init_fn=worker_init_fn
     )
     val_loader = DataLoader(
-        ImageDataset(mode="val", start=112500, end=150153),
+        val_dataset,
         batch_size=batch_size,
         shuffle=False,
         num_workers=4,
-        pin_memory=True,
+        pin_memory=device.type == 'cuda',
         worker_init_fn=worker_init_fn
     )
 
+    # Check once how far mixed precision strays from fp32 on this device
+    inputs, _ = next(iter(val_loader))
+    model.eval()
+    error = mixed_precision_error(model, prepare_inputs(inputs, device).float(), device)
+    if rank == 0:
+        print("Mixed precision max deviation from fp32: %.4f" % error)
+
     start_time = time.time()
 
-    for epoch in tqdm(range(start_epoch, num_epochs), position=0, leave=True, desc="Epochs"):
+    for epoch in tqdm(range(start_epoch, num_epochs), position=0, leave=True, desc="Epochs", disable=rank != 0):
         model.train()
-        running_loss = 0.0
-        for inputs, ground_truth_weights in tqdm(train_loader, position=1, leave=False, desc="Training " + str(epoch)):
-            inputs, ground_truth_weights = inputs.to(device, non_blocking=True), ground_truth_weights.to(device, non_blocking=True)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        # Accumulated on the device and read back once per epoch, or every log_interval steps for the progress bar
+        running_loss = torch.zeros((), dtype=torch.float64, device=device)
+        epoch_start = time.time()
+        progress = tqdm(train_loader, position=1, leave=False, desc="Training " + str(epoch), disable=rank != 0)
+        for batch, (inputs, ground_truth_weights) in enumerate(progress):
+            inputs, ground_truth_weights = prepare_inputs(inputs, device), ground_truth_weights.to(device, non_blocking=True)
+            seed = (epoch * len(train_loader) + batch) * world_size + rank
+            inputs = augment(inputs.float(), seed=seed).contiguous(memory_format=torch.channels_last)
 
             # Train the regression model
             optimizer.zero_grad(set_to_none=True)
 
             # Use autocast for the forward pass
-            with torch.cuda.amp.autocast():
+            with autocast(device):
                 reg_outputs = model(inputs) #[0,0,0][0.4, 0.6, 0.8]
-
-                truth_class = torch.argmax(ground_truth_weights[:, 0:3], 1)
-                top2_values, top2_indices = torch.topk(ground_truth_weights[:, 0:3], 2, dim=1)
-                second_class = top2_indices[:, 1]
-
-                class_loss = criterionDominant(reg_outputs[:,0:3], truth_class)
-                class_loss_2 = criterionDominant(reg_outputs[:,0:3], second_class)
-
-                v1 = reg_outputs[:, 3]
-                v2 = reg_outputs[:, 4]
-
-                values, indices = torch.topk(reg_outputs[:, 0:3], 3, dim=1)
-                pred_first = indices[:, 0]
-                pred_second = indices[:, 1]
-                pred_third = indices[:, 2]
-
-                w_a = (1 + v1 + v2) / 3.0
-                w_b = w_a - v1
-                w_c = w_a - v2
-                w_conn = reg_outputs[:, 5]
-                predicted_weights = torch.cat((w_a.unsqueeze(1), w_b.unsqueeze(1), w_c.unsqueeze(1)), dim=1)
-
-                current_batch_size = ground_truth_weights.size(0)
-                reg_loss_a = criterionReg(w_a, ground_truth_weights[:, 0:3][torch.arange(current_batch_size), pred_first])
-                reg_loss_b = criterionReg(w_b, ground_truth_weights[:, 0:3][torch.arange(current_batch_size), pred_second])
-                reg_loss_c = criterionReg(w_c, ground_truth_weights[:, 0:3][torch.arange(current_batch_size), pred_third])
-                reg_loss_conn = criterionReg(w_conn, ground_truth_weights[:, 3])
-                total_loss = ((1 - importance_second) * class_loss + importance_second * class_loss_2) + reg_loss_a + reg_loss_b + reg_loss_c + reg_loss_conn
+                total_loss, decoded = compute_loss(reg_outputs, ground_truth_weights, criterionDominant, criterionReg, importance_second)
 
             # Use the scaler for the backward pass
             scaler.scale(total_loss).backward()
             scaler.step(optimizer)
             scaler.update()
 
-            running_loss += total_loss.item()
-            
-        running_loss /= len(train_loader)
-
-        # Print the average loss for the epoch
-        out_train = ('[Epoch %d] Train_Loss: %.3f,' % (epoch + 1, running_loss))
+            running_loss += total_loss.detach()
+            if rank == 0 and (batch + 1) % log_interval == 0:
+                progress.set_postfix(loss=running_loss.item() / (batch + 1))
+        # Cuda steps are queued, the epoch is only over once the device has run them
+        synchronize(device)
+        step_time = (time.time() - epoch_start) / max(len(train_loader), 1)
 
         # Evaluate the model on the validation set
-        correct_total = 0
-        correct_second = 0
-        correct_goal = 0
-        correct_group = 0
-        correct_interact = 0
-        correct_connect = 0
+        correct = torch.zeros(6, dtype=torch.int64, device=device) # first, second, goal, group, interact, connect
         total = 0
-        total_val_loss = 0.0
+        total_val_loss = torch.zeros((), dtype=torch.float64, device=device)
         with torch.no_grad():
             model.eval()
-            for inputs, ground_truth_weights in tqdm(val_loader, position=1, leave=False, desc="Validation " + str(epoch)):
-                inputs, ground_truth_weights = inputs.to(device, non_blocking=True), ground_truth_weights.to(device, non_blocking=True)
+            for inputs, ground_truth_weights in tqdm(val_loader, position=1, leave=False, desc="Validation " + str(epoch), disable=rank != 0):
+                inputs, ground_truth_weights = prepare_inputs(inputs, device).float(), ground_truth_weights.to(device, non_blocking=True)
                 
                 # Use autocast for the forward pass
-                with torch.cuda.amp.autocast():
+                with autocast(device):
                     reg_outputs = model(inputs) #[0,0,0][0.4, 0.6]
-                    
-                    truth_class = torch.argmax(ground_truth_weights[:, 0:3], 1)
-                    top2_values, top2_indices = torch.topk(ground_truth_weights[:, 0:3], 2, dim=1)
-                    second_class = top2_indices[:, 1]
-
-                    class_loss = criterionDominant(reg_outputs[:,0:3], truth_class)
-                    class_loss_2 = criterionDominant(reg_outputs[:,0:3], second_class)
-
-                    v1 = reg_outputs[:, 3]
-                    v2 = reg_outputs[:, 4]
-
-                    values, indices = torch.topk(reg_outputs[:, 0:3], 3, dim=1)
-                    pred_first = indices[:, 0]
-                    pred_second = indices[:, 1]
-                    pred_third = indices[:, 2]
-
-                    w_a = (1 + v1 + v2) / 3.0
-                    w_b = w_a - v1
-                    w_c = w_a - v2
-                    w_conn = reg_outputs[:, 5]
-                    predicted_weights = torch.cat((w_a.unsqueeze(1), w_b.unsqueeze(1), w_c.unsqueeze(1)), dim=1)
-                    
-                    current_batch_size = ground_truth_weights.size(0)
-
-                    reg_loss_a = criterionReg(w_a, ground_truth_weights[:,0:3][torch.arange(current_batch_size), pred_first])
-                    reg_loss_b = criterionReg(w_b, ground_truth_weights[:,0:3][torch.arange(current_batch_size), pred_second])
-                    reg_loss_c = criterionReg(w_c, ground_truth_weights[:,0:3][torch.arange(current_batch_size), pred_third])
-                    reg_loss_conn = criterionReg(w_conn, ground_truth_weights[:, 3])
-                    total_val_loss += (((1 - importance_second) * class_loss + importance_second * class_loss_2) + reg_loss_a + reg_loss_b + reg_loss_c + reg_loss_conn)
-
-                predicted = torch.argmax(reg_outputs[:,0:3].data, 1)
-                correct_total += (predicted == truth_class).sum().item()
-                
-                top2_values, top2_indices = torch.topk(reg_outputs[:,0:3], 2, dim=1)
-                predicted_second = top2_indices[:, 1]
-                correct_second += (predicted_second == second_class).sum().item()
+                    val_loss, decoded = compute_loss(reg_outputs, ground_truth_weights, criterionDominant, criterionReg, importance_second)
+                    total_val_loss += val_loss
 
+                correct += count_correct(reg_outputs, ground_truth_weights, decoded, tolerance)
                 total += ground_truth_weights.size(0)
-                # Goal
-                diff = torch.abs(w_a - ground_truth_weights[torch.arange(current_batch_size), pred_first])
-                correct_goal += (diff <= tolerance).sum().item()
-                # Group
-                diff = torch.abs(w_b - ground_truth_weights[torch.arange(current_batch_size), pred_second])
-                correct_group += (diff <= tolerance).sum().item()
-                # Interact
-                diff = torch.abs(w_c - ground_truth_weights[torch.arange(current_batch_size), pred_third])
-                correct_interact += (diff <= tolerance).sum().item()
-                # Connect
-                diff = torch.abs(w_conn - ground_truth_weights[:,3])
-                correct_connect += (diff <= tolerance).sum().item()
+
+        # Summed over every process when distributed, so every process steps the scheduler alike
+        correct_total, correct_second, correct_goal, correct_group, correct_interact, correct_connect = correct.tolist()
+        (running_loss, train_batches, total_val_loss, val_batches, correct_total, correct_second, correct_goal, correct_group,
+         correct_interact, correct_connect, total) = all_reduce_sum([running_loss.item(), len(train_loader), total_val_loss.item(), len(val_loader), correct_total,
+                                                                     correct_second, correct_goal, correct_group, correct_interact, correct_connect, total], device)
+        running_loss /= train_batches
+
+        # Print the average loss for the epoch
+        out_train = ('[Epoch %d] Train_Loss: %.3f,' % (epoch + 1, running_loss))
 
         val_epoch_acc = correct_total / total
         val_second_acc = correct_second / total
@@ -205,14 +175,16 @@ if __name__ ==  '__main__':
         group_acc = correct_group / total
         interact_acc = correct_interact / total
         connect_acc = correct_connect / total
-        total_val_loss /= len(val_loader)
+        total_val_loss /= val_batches
 
         # Update the learning rate
         scheduler.step(total_val_loss)
 
         out_val = ('Val_Loss: %.3f, First_Acc: %.3f, Second_Acc: %.3f, A_Acc: %.3f, B_Acc: %.3f, C_Acc: %.3f, Connect_Acc: %.3f, Time(min): %.3f' 
         % (total_val_loss, val_epoch_acc, val_second_acc, goal_acc, group_acc, interact_acc, connect_acc, ((time.time()-start_time)/60)))
-        print("\n" + out_train, out_val)
+        if rank != 0:
+            continue
+        print("\n" + out_train, out_val, "Step(ms): %.2f" % (step_time * 1000))
 
         with open("output/saved_info/info.txt", "a") as f:
             f.write(out_train + " " + out_val + "\n")
@@ -222,12 +194,14 @@ if __name__ ==  '__main__':
         if (epoch+1) % 25 == 0:
             torch.save({
                 'epoch': epoch+1,
-                'model_state_dict': model.state_dict(),
+                'model_state_dict': unwrap(model).state_dict(),
                 'optimizer_reg_state_dict': optimizer.state_dict(),
                 'scheduler_reg_state_dict': scheduler.state_dict(),
                 'accuracy': val_epoch_acc,
                 'loss': total_val_loss
             }, f'output/saved_models/model_epoch_{epoch+1}.pt')
 
-
-
+    if in_memory and not keep_in_memory and rank == 0:
+        train_dataset.shared.release()
+    if world_size > 1:
+        torch.distributed.destroy_process_group()
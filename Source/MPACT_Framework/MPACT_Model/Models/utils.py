@@ -1,6 +1,10 @@
 # IMPORTS
 import matplotlib
-matplotlib.use('TkAgg')
+try:
+    matplotlib.use('TkAgg')
+except ImportError:
+    # No display, as on headless training machines, the plots are only saved to files
+    matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 import numpy as np
 from statistics import *
@@ -1,19 +1,25 @@
 import os
+import queue
+import threading
 import numpy as np
 import torch
 from Models.model import CNN_Class_Reg
+from Models.device import select_device, configure_threads, autocast, prepare_model, load_checkpoint, mixed_precision_error
 
 # Set device
-device = torch.device('cuda')
+device = select_device()
+configure_threads()
 torch.backends.cudnn.benchmark = True
-scaler = torch.cuda.amp.GradScaler()
+autocast_tolerance = 0.02 # Largest deviation from fp32 outputs accepted before predicting in fp32 instead
+use_autocast = None # Decided on the first batch by comparing against fp32
 
 # Initialize the models
-model = CNN_Class_Reg().to(device)
 current_file_dir = os.path.dirname(os.path.abspath(__file__))
-saved_model_path = current_file_dir + '\mpact_model.pt'
-checkpoint = torch.load(saved_model_path)
+saved_model_path = os.path.join(current_file_dir, 'mpact_model.pt')
+checkpoint = load_checkpoint(saved_model_path, device)
+model = CNN_Class_Reg()
 model.load_state_dict(checkpoint['model_state_dict'])
+model = prepare_model(model, device)
 
 def format_profile(p):
     if p is None: return None
@@ -38,16 +44,24 @@ def format_profile(p):
     return (a, b, c, d)
 
 def predict(images, masking):
+    global use_autocast
     stacked_images = np.stack(images, axis=0)
     inputs = torch.from_numpy(stacked_images)
+    # The images are (height, width, channels), permuted they already have the channels_last layout
     inputs = inputs.permute(0, 3, 1, 2)
 
     with torch.no_grad():
         model.eval()
-        inputs = inputs.contiguous().to(device)
+        inputs = inputs.contiguous(memory_format=torch.channels_last).to(device)
+
+        if use_autocast is None:
+            error = mixed_precision_error(model, inputs, device)
+            use_autocast = error <= autocast_tolerance
+            if not use_autocast:
+                print("Mixed precision deviates from fp32 by %.4f, predicting in fp32" % error)
 
         # Use autocast for the forward pass
-        with torch.cuda.amp.autocast():
+        with autocast(device, enabled=use_autocast):
             reg_outputs = model(inputs).float()
 
             v1 = reg_outputs[:,3]
@@ -105,4 +119,59 @@ def predict(images, masking):
 
             profiles = [tuple(row.tolist()) if mask == 1 else None for row, mask in zip(predicted_weights, masking)]
             profiles = [format_profile(p) for p in profiles]
-            return profiles
\ No newline at end of file
+            return profiles
+
+def predict_stream(windows, batch_size=256, max_buffered_bytes=2 ** 30):
+    """Runs predict over the (images, masking) of every window as they are produced and returns the profiles
+    in the same order as predict over all of them at once.
+
+    Images are grouped into batches of batch_size that a consumer thread feeds to the model while the next
+    windows are still being built. Once max_buffered_bytes of batches are waiting for the model, building
+    the next batch blocks until one is consumed.
+    """
+    profiles = []
+    failure = []
+    batches = None
+    consumer = None
+
+    def consume():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            # After a failure the remaining batches are only drained so the producer never blocks
+            if not failure:
+                try:
+                    profiles.extend(predict(*batch))
+                except BaseException as error:
+                    failure.append(error)
+
+    def put(images, masking):
+        nonlocal batches, consumer
+        if consumer is None:
+            batch_bytes = sum(image.nbytes for image in images)
+            batches = queue.Queue(maxsize=max(1, max_buffered_bytes // max(batch_bytes, 1)))
+            consumer = threading.Thread(target=consume, daemon=True)
+            consumer.start()
+        batches.put((images, masking))
+
+    # The sentinel always goes in, so the consumer returns even when building the windows raises
+    try:
+        images, masking = [], []
+        for window_images, window_masking in windows:
+            if failure:
+                break
+            images.extend(window_images)
+            masking.extend(window_masking)
+            while len(images) >= batch_size:
+                put(images[:batch_size], masking[:batch_size])
+                images, masking = images[batch_size:], masking[batch_size:]
+        if images and not failure:
+            put(images, masking)
+    finally:
+        if consumer is not None:
+            batches.put(None)
+            consumer.join()
+    if failure:
+        raise failure[0]
+    return profiles
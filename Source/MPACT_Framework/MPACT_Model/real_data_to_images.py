@@ -5,8 +5,11 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from sklearn.cluster import DBSCAN
 import json
+import hashlib
 from tqdm.auto import tqdm
-from inference import predict
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from Models.sample_encoding import encode_sample
 import time
 
 current_file_dir = os.path.dirname(os.path.abspath(__file__))
@@ -14,19 +17,26 @@ width, height = 64, 64
 max_dfg_distance = 5
 max_env_distance = 15
 max_speed_norm = 1
+sample_encoding = "dense" # Encoding of the saved reference samples: "dense", "sparse" or "sparse_uint8", see encode_sample
+window_buckets = None # Set in every process by init_window_worker
+window_velocity = None
+window_env_grid = None
 class Agent:
+    __slots__ = ('spawn_pos', 'goal_pos', 'timesteps', 'positions', 'speeds', 'stop_group_intervals',
+                 'stop_poi_durations', 'group_poi_ratio', 'timestep', 'velocity_x', 'velocity_z')
+
     def __init__(self):
         self.spawn_pos = None
         self.goal_pos = None
-        self.timesteps = []
-        self.positions = []
-        self.speeds = []
+        self.timesteps = np.empty(0)
+        self.positions = np.empty((0, 2))  # One (x, z) row per point
+        self.speeds = np.empty(0)
         self.stop_group_intervals = []
         self.stop_poi_durations = []
         self.group_poi_ratio = 1
         self.timestep = 0.04
-        self.velocity_x = []
-        self.velocity_z = []
+        self.velocity_x = np.empty(0)
+        self.velocity_z = np.empty(0)
 
     def add_trajectory_point(self, point, timestep, speed, vel_x, vel_z):
         self.timestep = timestep
@@ -35,36 +45,47 @@ class Agent:
         self.goal_pos = point
         speed = np.clip(speed, 0, max_speed_norm)
 
-        self.velocity_x.append(vel_x)
-        self.velocity_z.append(vel_z)
-        self.timesteps.append(timestep)
-        self.positions.append(point)
-        self.speeds.append(speed)
+        self.velocity_x = np.append(self.velocity_x, vel_x)
+        self.velocity_z = np.append(self.velocity_z, vel_z)
+        self.timesteps = np.append(self.timesteps, timestep)
+        self.positions = np.append(self.positions, [point], axis=0)
+        self.speeds = np.append(self.speeds, speed)
+
+    def set_trajectory(self, points, timesteps, speeds, vel_x, vel_z):
+        """Bulk equivalent of calling add_trajectory_point for every row of the arrays."""
+        self.positions = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.timesteps = np.asarray(timesteps, dtype=np.float64)
+        self.speeds = np.clip(speeds, 0, max_speed_norm)
+        self.velocity_x = np.asarray(vel_x, dtype=np.float64)
+        self.velocity_z = np.asarray(vel_z, dtype=np.float64)
+        self.timestep = float(self.timesteps[-1])
+        self.spawn_pos = tuple(self.positions[0].tolist())
+        self.goal_pos = tuple(self.positions[-1].tolist())
 
     def path_distance(self):
         return euclidean_distance(self.spawn_pos, self.goal_pos)
 
     def detect_stationary(self):
         N = 5
-        for index in range(0, len(self.timesteps), N): 
-            current_time = self.timesteps[index]
-            current_agent_position = self.positions[index]
-            window_speeds = self.speeds[index:index + N]
-            avg_speed = sum(window_speeds) / float(N)
-
-            if index <= 10 or index >= (len(self.timesteps) - 10):
-                continue
-            if avg_speed < 0.1:
-                if len(self.stop_group_intervals) == 0:
-                    self.stop_group_intervals.append([current_time - self.timestep, current_time, current_agent_position])
-                else:
-                    self.stop_group_intervals[-1][1] = current_time
-                    self.stop_group_intervals[-1][2] = current_agent_position
-                    if euclidean_distance(current_agent_position, self.stop_group_intervals[-1][2]) >= 1:
-                        self.stop_group_intervals.append([current_time - self.timestep, current_time, current_agent_position])
-            elif len(self.stop_group_intervals) > 0:
-                self.stop_group_intervals[-1][1] = current_time
-                self.stop_group_intervals[-1][2] = current_agent_position
+        # Mean speed of the N points starting at every N-th point, leaving out the first and last 10 points
+        index = np.arange(0, len(self.timesteps), N)
+        index = index[(index > 10) & (index < len(self.timesteps) - 10)]
+        if len(index) == 0:
+            return
+        total_speed = self.speeds[index]
+        for offset in range(1, N):
+            total_speed = total_speed + self.speeds[index + offset]
+        avg_speed = total_speed / float(N)
+
+        if len(self.stop_group_intervals) == 0:
+            stopped = np.flatnonzero(avg_speed < 0.1)
+            if len(stopped) == 0:
+                return
+            current_time = float(self.timesteps[index[stopped[0]]])
+            self.stop_group_intervals.append([current_time - self.timestep, current_time, None])
+        # An interval is never closed, every later window extends it up to the last one
+        self.stop_group_intervals[-1][1] = float(self.timesteps[index[-1]])
+        self.stop_group_intervals[-1][2] = tuple(self.positions[index[-1]].tolist())
 
     def compute_deviation(self, position):
         x1, y1 = self.spawn_pos
@@ -80,8 +101,19 @@ class Agent:
         return abs(A*x0 + B*y0 + C) / (A**2 + B**2)**0.5
 
     def average_deviation(self):
-        total_deviation = sum(self.compute_deviation(pos) for pos in self.positions)
-        return total_deviation / len(self.positions)
+        """Mean of compute_deviation over all positions."""
+        x1, y1 = self.spawn_pos
+        x2, y2 = self.goal_pos
+        A = y2 - y1
+        B = x1 - x2
+
+        if A < 0.0001 and B < 0.0001:
+            return 0.0
+
+        C = (x2*y1) - (x1*y2)
+        deviations = np.abs(A*self.positions[:, 0] + B*self.positions[:, 1] + C) / (A**2 + B**2)**0.5
+        # Summed in order, as the per position loop did
+        return float(np.cumsum(deviations)[-1]) / len(self.positions)
 
     def create_dfg_line(self, n=1):
         line_points = create_line_between_points(self.spawn_pos, self.goal_pos)
@@ -90,56 +122,36 @@ class Agent:
 class Cluster:
     def __init__(self, agents):
         self.agents = agents
+        self.positions, self.valid = self.pad_positions()
         self.interpersonal_distances = self.calculate_interpersonal_distances()
         self.center_of_mass_trajectory = self.calculate_center_of_mass_trajectory()
 
-    def euclidean_distance(self, pos1, pos2):
-        return np.linalg.norm(np.array(pos1) - np.array(pos2))
+    def pad_positions(self):
+        """Stacks the members' positions into an (agents, T, 2) array padded with zeros, T being the
+        longest trajectory, along with an (agents, T) mask of the timesteps each agent has a position."""
+        lengths = np.array([len(agent.positions) for agent in self.agents])
+        positions = np.zeros((len(self.agents), lengths.max(), 2))
+        for i, agent in enumerate(self.agents):
+            positions[i, :lengths[i]] = agent.positions
+        valid = np.arange(lengths.max()) < lengths[:, None]
+        return positions, valid
 
     def calculate_interpersonal_distances(self):
-        distances_per_timestep = []
-
-        max_timesteps = max([len(agent.positions) for agent in self.agents])
-        for timestep in range(max_timesteps):
-            total_distance = 0
-            num_pairs = 0
-
-            # Gather agents that have a position at this timestep
-            valid_agents = [agent for agent in self.agents if len(agent.positions) > timestep]
-
-            for i, agent1 in enumerate(valid_agents):
-                for j, agent2 in enumerate(valid_agents):
-                    if i < j:  # Avoid comparing an agent with itself and double counting
-                        total_distance += self.euclidean_distance(agent1.positions[timestep], agent2.positions[timestep])
-                        num_pairs += 1
-
-            avg_distance = total_distance / num_pairs if num_pairs != 0 else 0
-            distances_per_timestep.append(avg_distance)
+        # Pairs i < j in the order the agents are listed, so the per timestep sums add up as before
+        first, second = np.triu_indices(len(self.agents), 1)
+        diff = self.positions[first] - self.positions[second]
+        # Same dot product np.linalg.norm takes for a single pair
+        distances = np.sqrt(np.matmul(diff[..., None, :], diff[..., :, None])[..., 0, 0])
+        valid_pairs = self.valid[first] & self.valid[second]
 
-        return distances_per_timestep
+        total_distance = np.add.reduce(np.where(valid_pairs, distances, 0), axis=0)
+        num_pairs = valid_pairs.sum(axis=0)
+        return np.divide(total_distance, num_pairs, out=np.zeros_like(total_distance), where=num_pairs != 0)
 
     def calculate_center_of_mass_trajectory(self):
-        trajectory = []
-
-        max_timesteps = max([len(agent.positions) for agent in self.agents])
-        for timestep in range(max_timesteps):
-            sum_x, sum_y = 0, 0
-            num_valid_agents = 0  # Number of agents that have a position at this timestep
-
-            for agent in self.agents:
-                if len(agent.positions) > timestep:
-                    sum_x += agent.positions[timestep][0]
-                    sum_y += agent.positions[timestep][1]
-                    num_valid_agents += 1
-
-            if num_valid_agents > 0:
-                center_of_mass = (sum_x / num_valid_agents, sum_y / num_valid_agents)
-                trajectory.append(center_of_mass)
-            else:
-                # No agents have positions for this timestep; append None or a placeholder
-                trajectory.append(None)
-
-        return trajectory
+        # Every timestep up to the longest trajectory has at least one agent, so the count is never 0
+        num_valid_agents = self.valid.sum(axis=0)
+        return np.add.reduce(self.positions, axis=0) / num_valid_agents[:, None]
 
 class Cell:
     def __init__(self):
@@ -161,43 +173,53 @@ class Cell:
         self.agents.append(agent)
 
     def group_agents(self, group_distance=0.25):
-        groups = []
-
-        for i, agent in enumerate(self.agents):
-            for interval in agent.stop_group_intervals:
-                for j, other_agent in enumerate(self.agents):
-                    # Avoid checking the agent against itself and avoid checking pairs more than once
-                    if i < j:
-                        for other_interval in other_agent.stop_group_intervals:
-                            overlap_duration = overlapping_time(interval, other_interval)
-                            if overlap_duration > 0 and is_within_distance(interval[2], other_interval[2], group_distance):
-
-                                agent_group = next((g for g in groups if agent in g["agents"]), None)
-                                other_agent_group = next((g for g in groups if other_agent in g["agents"]), None)
-
-                                if not agent_group and not other_agent_group:  # Both agents are not in any group
-                                    groups.append({
-                                        "agents": {agent, other_agent},
-                                        "points": [interval[2], other_interval[2]],
-                                        "duration": overlap_duration
-                                    })
-
-                                elif agent_group and not other_agent_group:  # Only agent is in a group
-                                    agent_group["agents"].add(other_agent)
-                                    agent_group["points"].append(other_interval[2])
-
-                                elif not agent_group and other_agent_group:  # Only other_agent is in a group
-                                    other_agent_group["agents"].add(agent)
-                                    other_agent_group["points"].append(interval[2])
-
-                                elif agent_group != other_agent_group:  # Both agents are in different groups
-                                    # Merge groups
-                                    agent_group["agents"].update(other_agent_group["agents"])
-                                    agent_group["points"].extend(other_agent_group["points"])
-                                    agent_group["duration"] += overlap_duration  # Adjust duration
-                                    groups.remove(other_agent_group)
+        groups = {}      # Group id -> group, in creation order
+        parent = {}      # Disjoint-set forest over group ids, merged groups point to the surviving one
+        membership = {}  # Agent -> id of a group it joined
+
+        def find(group_id):
+            while parent[group_id] != group_id:
+                parent[group_id] = parent[parent[group_id]]
+                group_id = parent[group_id]
+            return group_id
+
+        for i, k, j, l, overlap_duration in stop_interval_contacts(self.agents, group_distance):
+            agent, other_agent = self.agents[i], self.agents[j]
+            interval = agent.stop_group_intervals[k]
+            other_interval = other_agent.stop_group_intervals[l]
+            agent_group = find(membership[agent]) if agent in membership else None
+            other_agent_group = find(membership[other_agent]) if other_agent in membership else None
+
+            if agent_group is None and other_agent_group is None:  # Both agents are not in any group
+                group_id = len(parent)
+                parent[group_id] = group_id
+                membership[agent] = membership[other_agent] = group_id
+                groups[group_id] = {
+                    "agents": {agent, other_agent},
+                    "points": [interval[2], other_interval[2]],
+                    "duration": overlap_duration
+                }
+
+            elif other_agent_group is None:  # Only agent is in a group
+                membership[other_agent] = agent_group
+                groups[agent_group]["agents"].add(other_agent)
+                groups[agent_group]["points"].append(other_interval[2])
+
+            elif agent_group is None:  # Only other_agent is in a group
+                membership[agent] = other_agent_group
+                groups[other_agent_group]["agents"].add(agent)
+                groups[other_agent_group]["points"].append(interval[2])
+
+            elif agent_group != other_agent_group:  # Both agents are in different groups
+                # Merge groups
+                merged_group = groups.pop(other_agent_group)
+                parent[other_agent_group] = agent_group
+                groups[agent_group]["agents"].update(merged_group["agents"])
+                groups[agent_group]["points"].extend(merged_group["points"])
+                groups[agent_group]["duration"] += overlap_duration  # Adjust duration
 
         # Convert agent sets to lists and remove duplicate points
+        groups = list(groups.values())
         for group in groups:
             group["points"] = list(set(group["points"]))
             group["agents"] = list(group["agents"])
@@ -205,70 +227,34 @@ class Cell:
         return groups
 
     def cluster_agents(self, threshold=0.2, traj_similarity=0.8, timestep_threshold=2):
-        def similar_trajectory(agent1, agent2):
-            similar_points = 0
-            for t1, pos1 in enumerate(agent1.positions):
-                for t2, pos2 in enumerate(agent2.positions):
-                    if abs(agent1.timesteps[t1] - agent2.timesteps[t2]) <= timestep_threshold:
-                        if euclidean_distance(pos1, pos2) < threshold:
-                            similar_points += 1
-                            break
-            percentage_similarity = similar_points / len(agent1.positions)
-            return percentage_similarity > traj_similarity
-
+        # One cluster per seed agent that has at least one similar agent, keyed by the seed's index
         clusters = {}
-        cluster_id = 0
-        for agent1 in self.agents:
-            for agent2 in self.agents:
-                if agent1 == agent2:
-                    continue
-                if similar_trajectory(agent1, agent2):
-                    if cluster_id not in clusters:
-                        clusters[cluster_id] = set()
-                    clusters[cluster_id].add(agent1)
-                    clusters[cluster_id].add(agent2)
-            cluster_id += 1
+        for cluster_id, other in similar_trajectories(self.agents, threshold, traj_similarity, timestep_threshold):
+            if cluster_id not in clusters:
+                clusters[cluster_id] = {self.agents[cluster_id]}
+            clusters[cluster_id].add(self.agents[other])
         return clusters
     
     def build_velocity_grid(self):
-        self.velocity_x_grid = np.zeros((width, height)) + 0.5
-        self.velocity_z_grid = np.zeros((width, height)) + 0.5
-        velocity_grid_quantity = np.zeros((width, height))
-        for agent in self.agents:
-            for i, point in enumerate(agent.positions):
-                x = math.floor(point[0] * width)
-                y = math.floor(point[1] * height)
-                if x < 0 or y < 0 or x >= width or y >= height:
-                    continue 
-                v_x = agent.velocity_x[i] / (max_speed_norm / 2)
-                v_z = agent.velocity_z[i] / (max_speed_norm / 2)
-                v_x_norm = normalize(v_x, -1, 1, -0.5, 0.5)
-                v_z_norm = normalize(v_z, -1, 1, -0.5, 0.5)
-                if abs(v_x_norm) < 0.01:
-                    v_x_norm += 0.05
-                if abs(v_z_norm) < 0.01:
-                    v_z_norm += 0.05    
-                self.velocity_x_grid[y, x] += v_x_norm
-                self.velocity_z_grid[y, x] += v_z_norm
-                velocity_grid_quantity[y, x] += 1
-        mask = velocity_grid_quantity > 0
-        self.velocity_x_grid[mask] = ((self.velocity_x_grid[mask] - 0.5) / velocity_grid_quantity[mask]) + 0.5
-        self.velocity_z_grid[mask] = ((self.velocity_z_grid[mask] - 0.5) / velocity_grid_quantity[mask]) + 0.5
+        points = np.concatenate([np.empty((0, 2))] + [np.reshape(agent.positions, (-1, 2)) for agent in self.agents])
+        velocity_x = np.concatenate([np.empty(0)] + [np.asarray(agent.velocity_x, dtype=np.float64) for agent in self.agents])
+        velocity_z = np.concatenate([np.empty(0)] + [np.asarray(agent.velocity_z, dtype=np.float64) for agent in self.agents])
+        x = np.floor(points[:, 0] * width).astype(np.int64)
+        y = np.floor(points[:, 1] * height).astype(np.int64)
+        v_x = velocity_x / (max_speed_norm / 2)
+        v_z = velocity_z / (max_speed_norm / 2)
+        self.velocity_x_grid, self.velocity_z_grid = rasterize_velocity(y, x, v_x, v_z)
 
     def build_dfg_grid(self):
-        self.dfg_grid = np.zeros((width, height))
-        dfg_grid_quantity = np.zeros((width, height))
+        spawn = [agent.spawn_pos for agent in self.agents]
+        goal = [agent.goal_pos for agent in self.agents]
+        values = []
         for agent in self.agents:
-            line_points = agent.create_dfg_line()
             avg_dfg = agent.average_deviation()
             path_dfg = agent.path_distance()
             dfg = (0.3 * avg_dfg + 0.7 * path_dfg) / 2
-            if line_points is None:
-                continue
-            for point in line_points:
-                x, y = point
-                self.dfg_grid[y, x] = np.clip(1 - dfg, 0, 1)
-                dfg_grid_quantity[y, x] += 1
+            values.append(np.clip(1 - dfg, 0, 1))
+        self.dfg_grid, dfg_grid_quantity = rasterize_lines(spawn, goal, values, accumulate=False)
         mask = dfg_grid_quantity > 0
         self.dfg_grid[mask] = self.dfg_grid[mask] / dfg_grid_quantity[mask]
 
@@ -290,8 +276,231 @@ class Cell:
     def build_connect_grid(self):
         self.connect_grid = np.zeros((width, height))
         clusters = self.cluster_agents()
-        clusters_objects = [Cluster(cluster) for cluster in clusters.values()]
-        draw_clusters(clusters_objects, self.connect_grid)
+        # Seeds of the same group yield identical clusters: build each once and draw it as often as it was found
+        multiplicities = {}
+        for cluster in clusters.values():
+            key = frozenset(cluster)
+            multiplicities[key] = multiplicities.get(key, 0) + 1
+        clusters_objects = [Cluster(cluster) for cluster in multiplicities]
+        draw_clusters(clusters_objects, self.connect_grid, multiplicities=list(multiplicities.values()))
+
+def cell_coordinates(pos_x, pos_z, grid_dim):
+    """Returns the cell (x, z) of every point and its position normalised within that cell."""
+    # TODO: Maybe fliP Z
+    point_x = pos_x
+    point_z = 1 - pos_z
+    cell_x = (point_x * grid_dim[0]).astype(np.int64)
+    cell_z = (point_z * grid_dim[1]).astype(np.int64)
+    if np.any((cell_x >= grid_dim[0]) | (cell_x < -grid_dim[0]) | (cell_z >= grid_dim[1]) | (cell_z < -grid_dim[1])):
+        raise IndexError("trajectory point outside of the cell grid")
+    # Negative indices wrap around like the nested list lookup they replace
+    cell_x %= grid_dim[0]
+    cell_z %= grid_dim[1]
+
+    increase_width = 1 / grid_dim[0]
+    increase_height = 1 / grid_dim[1]
+    cell_norm_x = normalize(point_x, cell_x * increase_width, (cell_x + 1) * increase_width, 0, 1)
+    cell_norm_z = normalize(point_z, cell_z * increase_height, (cell_z + 1) * increase_height, 0, 1)
+    return cell_x, cell_z, cell_norm_x, cell_norm_z
+
+class WindowBuckets:
+    """Assigns every trajectory point to its (window, cell) pairs without copying points per window.
+
+    The points are kept once, sorted by agent and then time, so the points of an agent inside a window
+    are one contiguous range found with searchsorted, however much the windows overlap. Windows are
+    inclusive [start_time, end_time] ranges, so a point lying exactly on a shared boundary belongs to
+    both neighbouring windows, as with assign_agents_to_cells. Consecutive points of one agent inside
+    the same window and cell form a run, and every run becomes one Agent of that cell.
+    """
+    def __init__(self, csv_data, grid_dim, windows):
+        self.grid_dim = grid_dim
+        self.windows = np.asarray(windows, dtype=np.float64).reshape(-1, 2)
+
+        dfs = list(csv_data.values())
+        frames = np.concatenate([df['frame'].to_numpy(np.float64) for df in dfs])
+        owners = np.repeat(np.arange(len(dfs)), [len(df) for df in dfs])
+
+        # Points outside of every window are dropped, as they were never assigned to a cell
+        order = np.argsort(frames, kind='stable')
+        lo = np.searchsorted(frames[order], self.windows[:, 0], side='left')
+        hi = np.searchsorted(frames[order], self.windows[:, 1], side='right')
+        covered = np.zeros(len(frames) + 1, dtype=np.int64)
+        np.add.at(covered, lo[hi > lo], 1)
+        np.add.at(covered, hi[hi > lo], -1)
+        inside = np.zeros(len(frames), dtype=bool)
+        inside[order] = np.cumsum(covered[:-1]) > 0
+
+        # One key per point ordering it by agent and then by time, a window is a key range per agent
+        self.times, ranks = np.unique(frames[inside], return_inverse=True)
+        self.span = len(self.times) + 1
+        keys = owners[inside] * self.span + ranks.reshape(-1)
+        points = np.flatnonzero(inside)[np.argsort(keys, kind='stable')]
+        self.keys = np.sort(keys, kind='stable')
+        self.agents = np.unique(owners[points])
+
+        def column(name):
+            return np.concatenate([df[name].to_numpy(np.float64) for df in dfs])[points]
+
+        self.cell_x, self.cell_z, cell_norm_x, cell_norm_z = cell_coordinates(column('pos_x'), column('pos_z'), grid_dim)
+
+        self.points = np.stack((cell_norm_x, cell_norm_z), axis=1)
+        self.frames = frames[points]
+        self.speeds = column('speed')
+        self.velocity_x = column('velocity_x')
+        self.velocity_z = column('velocity_z')
+
+        # A run also starts wherever the agent or the cell changes from one point to the next
+        owners = owners[points]
+        change = np.ones(len(points), dtype=bool)
+        change[1:] = (np.diff(owners) != 0) | (np.diff(self.cell_x) != 0) | (np.diff(self.cell_z) != 0)
+        self.breaks = np.append(np.flatnonzero(change), len(points))
+
+    def __len__(self):
+        return len(self.windows)
+
+    def runs(self, window):
+        """(starts, ends) of the runs of a window into the point arrays, in (agent, time) order."""
+        first = np.searchsorted(self.times, self.windows[window, 0], side='left')
+        last = np.searchsorted(self.times, self.windows[window, 1], side='right')
+        lo = np.searchsorted(self.keys, self.agents * self.span + first, side='left')
+        hi = np.searchsorted(self.keys, self.agents * self.span + last, side='left')
+        lo, hi = lo[hi > lo], hi[hi > lo]
+        # Every agent range starts a run, and so does every break strictly inside it
+        inner_lo = np.searchsorted(self.breaks, lo, side='right')
+        inner_hi = np.searchsorted(self.breaks, hi, side='left')
+        counts = inner_hi - inner_lo
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        inner = self.breaks[np.repeat(inner_lo, counts) + offsets]
+        starts = np.sort(np.concatenate((lo, inner)))
+        ends = np.minimum(self.breaks[np.searchsorted(self.breaks, starts, side='right')],
+                          np.repeat(hi, counts + 1))
+        return starts, ends
+
+    def window_key(self, window, seed):
+        """Hex digest of the points of a window added to a copy of the hashlib object seed."""
+        starts, ends = self.runs(window)
+        lengths = ends - starts
+        offsets = np.cumsum(lengths) - lengths
+        rows = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        digest = seed.copy()
+        for array in (self.points[rows], self.frames[rows], self.speeds[rows],
+                      self.velocity_x[rows], self.velocity_z[rows],
+                      offsets, self.cell_x[starts], self.cell_z[starts]):
+            digest.update(np.int64(array.size).tobytes())
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def cells(self, window):
+        cells = create_cells(self.grid_dim)
+        for start, end in zip(*self.runs(window)):
+            agent = Agent()
+            agent.set_trajectory(self.points[start:end], self.frames[start:end], self.speeds[start:end],
+                                 self.velocity_x[start:end], self.velocity_z[start:end])
+            cells[self.cell_z[start]][self.cell_x[start]].add_agent(agent)
+        return cells
+
+class VelocityAccumulator:
+    """Cumulative sums over time of the velocity channels of every pixel of every cell.
+
+    The velocity channels only add up the normalised velocities of the points on each pixel, so the
+    channels of any window, overlapping others or not and of any length, are two lookups per pixel
+    into the sums instead of rasterising its points again. Points are sorted by pixel and then time
+    and windows are inclusive [start_time, end_time] ranges like in WindowBuckets.
+    """
+    def __init__(self, csv_data, grid_dim):
+        self.grid_dim = grid_dim
+        dfs = list(csv_data.values())
+
+        def column(name):
+            return np.concatenate([df[name].to_numpy(np.float64) for df in dfs])
+
+        cell_x, cell_z, cell_norm_x, cell_norm_z = cell_coordinates(column('pos_x'), column('pos_z'), grid_dim)
+        x = np.floor(cell_norm_x * width).astype(np.int64)
+        y = np.floor(cell_norm_z * height).astype(np.int64)
+        inside = (y >= 0) & (x >= 0) & (y < width) & (x < height)
+        pixels = np.ravel_multi_index((cell_z[inside], cell_x[inside], y[inside], x[inside]), (grid_dim[1], grid_dim[0], width, height))
+        self.times, ranks = np.unique(column('frame')[inside], return_inverse=True)
+        velocity_x = normalize_velocity(column('velocity_x')[inside] / (max_speed_norm / 2))
+        velocity_z = normalize_velocity(column('velocity_z')[inside] / (max_speed_norm / 2))
+
+        # One key per point ordering it by pixel and then by time, the sums run over that order
+        self.span = len(self.times) + 1
+        keys = pixels * self.span + ranks.reshape(-1)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.pixels = np.unique(pixels)
+        self.sum_x = np.concatenate(([0], np.cumsum(velocity_x[order])))
+        self.sum_z = np.concatenate(([0], np.cumsum(velocity_z[order])))
+
+    def grids(self, start_time, end_time):
+        """Returns the velocity x and z channels of every cell of the window, each an array indexed
+        [cell row][cell column] like the cells of a window."""
+        first = np.searchsorted(self.times, start_time, side='left')
+        last = np.searchsorted(self.times, end_time, side='right')
+        lo = np.searchsorted(self.keys, self.pixels * self.span + first, side='left')
+        hi = np.searchsorted(self.keys, self.pixels * self.span + last, side='left')
+        quantity = hi - lo
+        mask = quantity > 0
+
+        shape = (self.grid_dim[1], self.grid_dim[0], width, height)
+        velocity_x_grids = np.zeros(np.prod(shape)) + 0.5
+        velocity_z_grids = np.zeros(np.prod(shape)) + 0.5
+        velocity_x_grids[self.pixels[mask]] += (self.sum_x[hi] - self.sum_x[lo])[mask] / quantity[mask]
+        velocity_z_grids[self.pixels[mask]] += (self.sum_z[hi] - self.sum_z[lo])[mask] / quantity[mask]
+        return velocity_x_grids.reshape(shape), velocity_z_grids.reshape(shape)
+
+class WindowImageCache:
+    """On-disk cache of the images and masks of a window under a content hash of everything they are built from.
+
+    Every entry is one .npz file whose modification time records its last use. Once the files add up to
+    more than max_bytes, the least recently used ones are removed.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.entries = {}  # File name -> (last use, size)
+        for entry in os.scandir(path):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                self.entries[entry.name] = (stat.st_mtime, stat.st_size)
+        self.evict()
+
+    def get(self, key):
+        name = key + ".npz"
+        if name not in self.entries:
+            return None
+        file_path = os.path.join(self.path, name)
+        try:
+            with np.load(file_path) as data:
+                images, masking = list(data["images"]), data["masking"].tolist()
+            os.utime(file_path)
+        except (OSError, ValueError, KeyError):
+            # Unreadable or removed from outside, build it again
+            del self.entries[name]
+            return None
+        self.entries[name] = (time.time(), self.entries[name][1])
+        return images, masking
+
+    def put(self, key, images, masking):
+        name = key + ".npz"
+        file_path = os.path.join(self.path, name)
+        with open(file_path + ".tmp", "wb") as file:
+            np.savez(file, images=np.stack(images), masking=np.asarray(masking, dtype=np.int8))
+        os.replace(file_path + ".tmp", file_path)
+        self.entries[name] = (time.time(), os.path.getsize(file_path))
+        self.evict()
+
+    def evict(self):
+        total = sum(size for _, size in self.entries.values())
+        for name in sorted(self.entries, key=lambda name: self.entries[name][0]):
+            if total <= self.max_bytes:
+                break
+            total -= self.entries.pop(name)[1]
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
 
 def euclidean_distance(pos1, pos2):
     return np.sqrt((pos2[0] - pos1[0]) ** 2 + (pos2[1] - pos1[1]) ** 2)
@@ -307,10 +516,126 @@ def is_within_distance(point1, point2, distance):
     # Check if two points are within a certain distance
     return ((point1[0] - point2[0])**2 + (point1[1] - point2[1])**2)**0.5 <= distance
 
+def stop_interval_contacts(agents, group_distance):
+    """Returns (agent_index, interval_index, other_agent_index, other_interval_index, overlap_duration)
+    for every pair of stop intervals of two different agents that overlap in time and lie within
+    group_distance, ordered as the pairwise comparison over agents and intervals visited them.
+
+    Intervals are swept in start order and kept in a spatial hash of group_distance-sized buckets
+    while they are still open, so only concurrent intervals in neighbouring buckets are compared.
+    """
+    intervals = [(i, k, interval) for i, agent in enumerate(agents) for k, interval in enumerate(agent.stop_group_intervals)]
+    bucket_size = group_distance if group_distance > 0 else 1
+    open_intervals = {}
+    contacts = []
+    for i, k, interval in sorted(intervals, key=lambda entry: entry[2][0]):
+        bucket_x = math.floor(interval[2][0] / bucket_size)
+        bucket_z = math.floor(interval[2][1] / bucket_size)
+        for neighbour in ((bucket_x + dx, bucket_z + dz) for dx in (-1, 0, 1) for dz in (-1, 0, 1)):
+            bucket = open_intervals.get(neighbour)
+            if not bucket:
+                continue
+            # Intervals that ended before this one starts cannot overlap any of the later ones either
+            bucket[:] = [entry for entry in bucket if entry[2][1] > interval[0]]
+            for j, l, other_interval in bucket:
+                if i == j:
+                    continue
+                overlap_duration = overlapping_time(interval, other_interval)
+                if overlap_duration > 0 and is_within_distance(interval[2], other_interval[2], group_distance):
+                    contacts.append((i, k, j, l, overlap_duration) if i < j else (j, l, i, k, overlap_duration))
+        open_intervals.setdefault((bucket_x, bucket_z), []).append((i, k, interval))
+    contacts.sort(key=lambda contact: contact[:4])
+    return contacts
+
+def similar_trajectories(agents, threshold, traj_similarity, timestep_threshold):
+    """Returns the (agent, other_agent) index pairs, in agent order, where more than traj_similarity
+    of the agent's points have a point of the other agent closer than threshold and at most
+    timestep_threshold apart in time.
+
+    Points are hashed into a grid of threshold-sized buckets and sorted by (bucket, time), so the
+    candidates of a point are found with searchsorted over the time windows of the 3x3
+    neighbouring buckets instead of comparing every pair of points of every pair of agents.
+    """
+    if len(agents) < 2 or threshold <= 0:
+        return []
+    lengths = np.array([len(agent.positions) for agent in agents])
+    owners = np.repeat(np.arange(len(agents)), lengths)
+    points = np.concatenate([np.reshape(agent.positions, (-1, 2)) for agent in agents]).astype(np.float64)
+    times = np.concatenate([np.asarray(agent.timesteps, dtype=np.float64) for agent in agents])
+
+    # Grid hash with a one bucket border so that neighbour offsets never wrap around
+    bucket_x = np.floor(points[:, 0] / threshold).astype(np.int64)
+    bucket_z = np.floor(points[:, 1] / threshold).astype(np.int64)
+    bucket_x -= bucket_x.min() - 1
+    bucket_z -= bucket_z.min() - 1
+    rows = bucket_z.max() + 2
+    buckets = bucket_x * rows + bucket_z
+
+    # One sorted key per point: its bucket, then its time inside the bucket
+    span = times.max() - times.min() + 2 * timestep_threshold + 1
+    margin = 1e-9 * span
+    keys = buckets * span + (times - times.min())
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    candidates_p, candidates_q = [], []
+    for offset in (-rows - 1, -rows, -rows + 1, -1, 0, 1, rows - 1, rows, rows + 1):
+        centre = (buckets + offset) * span + (times - times.min())
+        lo = np.searchsorted(sorted_keys, centre - timestep_threshold - margin, side='left')
+        hi = np.searchsorted(sorted_keys, centre + timestep_threshold + margin, side='right')
+        counts = hi - lo
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        candidates_p.append(np.repeat(np.arange(len(points)), counts))
+        candidates_q.append(order[starts + np.arange(counts.sum())])
+    p = np.concatenate(candidates_p)
+    q = np.concatenate(candidates_q)
+
+    # Exact tests, as in the pairwise comparison they replace
+    distances = np.sqrt((points[q, 0] - points[p, 0]) ** 2 + (points[q, 1] - points[p, 1]) ** 2)
+    matches = (owners[p] != owners[q]) & (distances < threshold) & (np.abs(times[p] - times[q]) <= timestep_threshold)
+    p, other = p[matches], owners[q[matches]]
+
+    # A point counts once per other agent, however many of its points are close
+    matched_points = np.unique(p * len(agents) + other)
+    pair_keys, similar_points = np.unique(owners[matched_points // len(agents)] * len(agents) + matched_points % len(agents), return_counts=True)
+    agent, other_agent = pair_keys // len(agents), pair_keys % len(agents)
+    similar = similar_points / lengths[agent] > traj_similarity
+    return list(zip(agent[similar].tolist(), other_agent[similar].tolist()))
+
 def normalize(value, min_value, max_value, new_min, new_max):
     normalized = ((value - min_value) / (max_value - min_value)) * (new_max - new_min) + new_min
     return normalized
 
+def normalize_velocity(velocity):
+    """Maps velocities from [-1, 1] to [-0.5, 0.5] and nudges near-zero values by 0.05 so they stay visible."""
+    velocity_norm = normalize(velocity, -1, 1, -0.5, 0.5)
+    return np.where(np.abs(velocity_norm) < 0.01, velocity_norm + 0.05, velocity_norm)
+
+def accumulate_pixels(rows, cols, values=None, shape=(width, height)):
+    """Scatter-adds values onto the pixels (rows, cols) of a grid. Returns the per-pixel sums and counts."""
+    flat = np.ravel_multi_index((rows, cols), shape)
+    size = shape[0] * shape[1]
+    counts = np.bincount(flat, minlength=size).reshape(shape).astype(np.float64)
+    if values is None:
+        return counts, counts
+    sums = np.bincount(flat, weights=values, minlength=size).reshape(shape)
+    return sums, counts
+
+def rasterize_velocity(rows, cols, velocity_x, velocity_z):
+    """Builds both velocity channels from whole point arrays: the mean normalised velocity per pixel
+    on a 0.5 background. Velocities are expected in [-1, 1] and points outside the grid are dropped."""
+    inside = (rows >= 0) & (cols >= 0) & (rows < width) & (cols < height)
+    rows, cols = rows[inside], cols[inside]
+    sum_x, quantity = accumulate_pixels(rows, cols, normalize_velocity(velocity_x[inside]))
+    sum_z, _ = accumulate_pixels(rows, cols, normalize_velocity(velocity_z[inside]))
+
+    velocity_x_grid = np.zeros((width, height)) + 0.5
+    velocity_z_grid = np.zeros((width, height)) + 0.5
+    mask = quantity > 0
+    velocity_x_grid[mask] += sum_x[mask] / quantity[mask]
+    velocity_z_grid[mask] += sum_z[mask] / quantity[mask]
+    return velocity_x_grid, velocity_z_grid
+
 def get_grid_separation(width, height, multiplier):
     divisor = math.gcd(width, height)
     width_normalized = width / divisor
@@ -322,8 +647,61 @@ def get_grid_separation(width, height, multiplier):
     height_normalized = math.floor(multiplier * height_normalized)
     return (width_normalized, height_normalized)
 
-def skip_rows(index, step):
-    return index % step != 0
+def load_trajectory_csv(file_path, row_step):
+    """Reads an agent CSV keeping every row_step-th row and adds its speed and velocity columns."""
+    df = pd.read_csv(file_path, header=None, names=['frame', 'pos_x', 'pos_z'], sep=';', usecols=[0, 1, 2])
+    # The first line is always dropped, then only lines whose index is a multiple of row_step are kept
+    df = df.iloc[row_step::row_step].reset_index(drop=True)
+
+    # Calculate the speed based on consecutive positions
+    df['distance'] = np.sqrt((df['pos_x'].diff())**2 + (df['pos_z'].diff())**2)
+    df['time_diff'] = df['frame'].diff()
+    df['delta_x'] = df['pos_x'].diff()
+    df['delta_z'] = df['pos_z'].diff()
+    df['speed'] = df['distance'] / df['time_diff']
+    # Calculate the change in position for x and z axes
+    # Calculate velocities
+    df['velocity_x'] = df['delta_x'] / df['time_diff']
+    df['velocity_z'] = df['delta_z'] / df['time_diff']
+    df.dropna(inplace=True)  # Remove the first row with NaN values due to the diff() calculations
+    df.drop(columns=['distance', 'time_diff', 'delta_x', 'delta_z'], inplace=True)
+    return df
+
+def load_trajectory_csvs(directory_path, csv_files, row_step, n_processes=1):
+    """Returns {filename: DataFrame} for the given agent CSVs, reading them across n_processes.
+
+    Parsed files are cached in the Cache folder that mirrors Trajectories, one cache per row_step.
+    A file is parsed again only when its modification time or size changed since it was cached.
+    """
+    cache_path = directory_path.replace("Trajectories", "Cache")
+    cache_file = os.path.join(cache_path, "trajectories_" + str(row_step) + ".pkl")
+    cache = pd.read_pickle(cache_file) if os.path.exists(cache_file) else {}
+
+    stamps = {}
+    for filename in csv_files:
+        stat = os.stat(os.path.join(directory_path, filename))
+        stamps[filename] = (stat.st_mtime_ns, stat.st_size)
+    stale = [filename for filename in csv_files if filename not in cache or cache[filename][0] != stamps[filename]]
+
+    if stale:
+        file_paths = [os.path.join(directory_path, filename) for filename in stale]
+        if n_processes > 1 and len(stale) > 1:
+            with ProcessPoolExecutor(max_workers=n_processes) as executor:
+                chunksize = max(1, len(stale) // (4 * n_processes))
+                dfs = list(executor.map(load_trajectory_csv, file_paths, [row_step] * len(stale), chunksize=chunksize))
+        else:
+            dfs = [load_trajectory_csv(file_path, row_step) for file_path in file_paths]
+        for filename, df in zip(stale, dfs):
+            cache[filename] = (stamps[filename], df)
+
+    if stale or len(cache) != len(csv_files):
+        # Drop files that are gone and write through a temporary file so an interrupted run leaves no broken cache
+        cache = {filename: cache[filename] for filename in csv_files}
+        os.makedirs(cache_path, exist_ok=True)
+        pd.to_pickle(cache, cache_file + ".tmp", compression=None)
+        os.replace(cache_file + ".tmp", cache_file)
+
+    return {filename: cache[filename][1] for filename in csv_files}
 
 def iqr_bounds(df, column_name, low, high):
     Q1 = df[column_name].quantile(low)
@@ -352,29 +730,33 @@ def is_close(a, b, dist_threshold, frame_threshold):
     return dist(a, b) < dist_threshold and frame_diff(a, b) < frame_threshold
 
 def detect_groups(agent_dict, dist_threshold=0.25, frame_threshold=25):
+    """Assigns every agent the id of the first group that has a member close to it, or a new group.
+
+    Agents are kept in a hash of spawn frame and spawn position buckets the size of the thresholds.
+    Two close agents are less than dist_threshold apart at spawn and spawn less than frame_threshold
+    frames apart, so only agents in the neighbouring buckets need to be checked.
+    """
+    cell_size = dist_threshold if dist_threshold > 0 else 1
+    frame_size = frame_threshold if frame_threshold > 0 else 1
     group_id = 0
-    agent_groups = {}
+    agent_buckets = {}
     for frame in agent_dict:
         for agent in agent_dict[frame]:
-            if not agent_groups:
-                agent.append(group_id)
-                agent_groups[group_id] = [agent]
+            frame_bucket = math.floor(agent[0] / frame_size)
+            bucket_x = math.floor(agent[1] / cell_size)
+            bucket_z = math.floor(agent[2] / cell_size)
+            # Groups are numbered in creation order, so the first matching group has the lowest id
+            gid = min((a[6] for df in (-1, 0, 1) for dx in (-1, 0, 1) for dz in (-1, 0, 1)
+                       for a in agent_buckets.get((frame_bucket + df, bucket_x + dx, bucket_z + dz), ())
+                       if is_close(agent, a, dist_threshold, frame_threshold)), default=None)
+            if gid is None:
+                gid = group_id
                 group_id += 1
-            else:
-                added_to_group = False
-                for gid, agents in agent_groups.items():
-                    if any(is_close(agent, a, dist_threshold, frame_threshold) for a in agents):
-                        agent.append(gid)
-                        agent_groups[gid].append(agent)
-                        added_to_group = True
-                        break
-                if not added_to_group:
-                    agent.append(group_id)
-                    agent_groups[group_id] = [agent]
-                    group_id += 1
+            agent.append(gid)
+            agent_buckets.setdefault((frame_bucket, bucket_x, bucket_z), []).append(agent)
     return agent_dict
 
-def read_csv_files_and_env_json(directory_path, row_step, framerate, separation):
+def read_csv_files_and_env_json(directory_path, row_step, framerate, separation, n_processes=1):
     with open(directory_path + "env.json") as json_file:
         data_json = json.load(json_file)
         scene_objects_dict = data_json["EnvironmentObjects"]
@@ -397,27 +779,9 @@ def read_csv_files_and_env_json(directory_path, row_step, framerate, separation)
 
     row_threshold = 20
 
-    for filename in csv_files:
-        # Read the CSV file into a pandas DataFrame and assign column names
-        df = pd.read_csv(os.path.join(directory_path, filename), 
-            header=None, names=['frame', 'pos_x', 'pos_z'], sep=';', 
-            skiprows=lambda index: index == 0 or skip_rows(index, row_step),
-            usecols=[0, 1, 2])
+    for filename, df in load_trajectory_csvs(directory_path, csv_files, row_step, n_processes).items():
         if df.shape[0] < row_threshold:
             continue
-        
-        # Calculate the speed based on consecutive positions
-        df['distance'] = np.sqrt((df['pos_x'].diff())**2 + (df['pos_z'].diff())**2)
-        df['time_diff'] = df['frame'].diff()
-        df['delta_x'] = df['pos_x'].diff()
-        df['delta_z'] = df['pos_z'].diff()
-        df['speed'] = df['distance'] / df['time_diff']
-        # Calculate the change in position for x and z axes
-        # Calculate velocities
-        df['velocity_x'] = df['delta_x'] / df['time_diff']
-        df['velocity_z'] = df['delta_z'] / df['time_diff']
-        df.dropna(inplace=True)  # Remove the first row with NaN values due to the diff() calculations
-        df.drop(columns=['distance', 'time_diff', 'delta_x', 'delta_z'], inplace=True)
         csv_data_norm[filename] = df
         all_dfs.append(df)
 
@@ -481,64 +845,46 @@ def point_to_cell(point, grid_dim):
     col = int(point[1] * grid_dim[1])
     return (row, col)
 
-def draw_clusters(clusters, img, group_distance=0.25):
-    img_quantity = np.zeros((width, height))
+def draw_clusters(clusters, img, group_distance=0.25, multiplicities=None):
     if len(clusters) == 0:
         return
+    if multiplicities is None:
+        multiplicities = [1] * len(clusters)
 
     max_distance = group_distance
     min_distance = 0
 
-    for cluster in clusters:
+    pos_a, pos_b, values, weights = [], [], [], []
+    for cluster, multiplicity in zip(clusters, multiplicities):
+        # Consecutive centers of mass are joined, each segment valued by the distance at its start
         trajectory = cluster.center_of_mass_trajectory
-        distances = cluster.interpersonal_distances
-
-        for i in range(len(trajectory) - 1):
-            start_point = trajectory[i]
-            end_point = trajectory[i + 1]
-
-            if start_point is not None and end_point is not None:
-                # Get all points for the line segment between the two points
-                line_points = create_line_between_points(start_point, end_point)
-                if line_points is None:
-                    continue
-
-                for point in line_points:
-                    x, z = point
-                    # Normalize the distance for this point
-                    value = distances[i]
-                    img[z][x] += normalize((1 - value), 0, 1, 0.1, 1)
-                    img_quantity[z][x] += 1
+        distances = cluster.interpersonal_distances[:-1]
+        pos_a.append(trajectory[:-1])
+        pos_b.append(trajectory[1:])
+        values.append(normalize((1 - distances), 0, 1, 0.1, 1))
+        weights.append(np.full(len(trajectory) - 1, multiplicity))
+
+    pos_a, pos_b, values, weights = (np.concatenate(part) for part in (pos_a, pos_b, values, weights))
+    lines, img_quantity = rasterize_lines(pos_a, pos_b, values, weights=weights)
+    img += lines
     mask = img_quantity > 0
     img[mask] = img[mask] / img_quantity[mask]
     return img
 
 def fill_polygon(grid, groups, max_duration=15):
-    grid_quantity = np.zeros((width, height))
+    pos_a, pos_b, values = [], [], []
     for group in groups:
         agent_positions = group["points"] # Now, we get positions from the group object
         duration = group["duration"]  # We get the duration from the group object
 
-        if len(agent_positions) > 2:
-            for i in range(len(agent_positions) - 1):
-                line_points = create_line_between_points(agent_positions[i], agent_positions[i+1])
-                if line_points is None:
-                     continue
-                for point in line_points:
-                    x, y = point
-                    # Normalize the distance for this point
-                    grid[y, x] += np.clip(duration / max_duration, 0, 1)
-                    grid_quantity[y, x] += 1
-        elif len(agent_positions) == 2:
-            line_points = create_line_between_points(agent_positions[0], agent_positions[1])
-            if line_points is None:
-                    continue
-            for point in line_points:
-                x, y = point
-                # Normalize the distance for this point
-                grid[y, x] += np.clip(duration / max_duration, 0, 1)
-                grid_quantity[y, x] += 1
+        # Consecutive points are joined, which for two points is a single line
+        if len(agent_positions) >= 2:
+            pos_a.extend(agent_positions[:-1])
+            pos_b.extend(agent_positions[1:])
+            values.extend([np.clip(duration / max_duration, 0, 1)] * (len(agent_positions) - 1))
 
+    lines, grid_quantity = rasterize_lines(pos_a, pos_b, values)
+    grid += lines
     mask = grid_quantity > 0
     grid[mask] = grid[mask] / grid_quantity[mask]
     return grid
@@ -580,7 +926,82 @@ def create_line_between_points(pos_a, pos_b):
     line_points = bresenham_line(point_a_x, point_a_z, point_b_x, point_b_z)
     return line_points
 
-def assign_agents_to_cells(csv_data, grid_dim, duration):
+def bresenham_lines(x1, y1, x2, y2):
+    """Vectorised bresenham_line for N segments at once.
+
+    Every still unfinished segment advances one step per iteration, so the loop runs
+    max(dx, dy) + 1 times instead of once per pixel. Returns the segment index, x and y
+    of every generated point, in the same per-segment order as bresenham_line.
+    """
+    x, y = np.array(x1, dtype=np.int64), np.array(y1, dtype=np.int64)
+    x2, y2 = np.asarray(x2, dtype=np.int64), np.asarray(y2, dtype=np.int64)
+    dx = np.abs(x2 - x)
+    dy = np.abs(y2 - y)
+    sx = np.where(x < x2, 1, -1)
+    sy = np.where(y < y2, 1, -1)
+    err = dx - dy
+
+    segments, points_x, points_y = [], [], []
+    active = np.arange(len(x))
+    while active.size:
+        segments.append(active)
+        points_x.append(x[active])
+        points_y.append(y[active])
+        active = active[(x[active] != x2[active]) | (y[active] != y2[active])]
+        e2 = 2 * err[active]
+        step_x = active[e2 > -dy[active]]
+        step_y = active[e2 < dx[active]]
+        err[step_x] -= dy[step_x]
+        x[step_x] += sx[step_x]
+        err[step_y] += dx[step_y]
+        y[step_y] += sy[step_y]
+
+    if not segments:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    segments = np.concatenate(segments)
+    order = np.argsort(segments, kind='stable')
+    return segments[order], np.concatenate(points_x)[order], np.concatenate(points_y)[order]
+
+def create_lines_between_points(pos_a, pos_b):
+    """Vectorised create_line_between_points for N segments given as (N, 2) positions.
+    Segments with an end outside the grid are skipped. Returns the segment index, x and y of every pixel."""
+    pos_a = np.reshape(np.asarray(pos_a, dtype=np.float64), (-1, 2))
+    pos_b = np.reshape(np.asarray(pos_b, dtype=np.float64), (-1, 2))
+    point_a_x = np.floor(pos_a[:, 0] * width).astype(np.int64)
+    point_a_z = np.floor(pos_a[:, 1] * height).astype(np.int64)
+    point_b_x = np.floor(pos_b[:, 0] * width).astype(np.int64)
+    point_b_z = np.floor(pos_b[:, 1] * height).astype(np.int64)
+
+    inside = (point_a_x >= 0) & (point_a_z >= 0) & (point_a_x <= width - 1) & (point_a_z <= height - 1)
+    inside &= (point_b_x >= 0) & (point_b_z >= 0) & (point_b_x <= width - 1) & (point_b_z <= height - 1)
+    segments, xs, zs = bresenham_lines(point_a_x[inside], point_a_z[inside], point_b_x[inside], point_b_z[inside])
+    return np.flatnonzero(inside)[segments], xs, zs
+
+def rasterize_lines(pos_a, pos_b, values, accumulate=True, weights=None):
+    """Draws N segments with one value each. Returns the per-pixel sum of the values and
+    the number of segments covering every pixel.
+
+    A segment with weight k counts as if it was drawn k times. With accumulate=False a
+    pixel holds the value of the last segment drawn over it instead of the sum.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    segments, xs, ys = create_lines_between_points(pos_a, pos_b)
+    if weights is None:
+        grid, quantity = accumulate_pixels(ys, xs, values[segments])
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        grid, _ = accumulate_pixels(ys, xs, values[segments] * weights[segments])
+        quantity, _ = accumulate_pixels(ys, xs, weights[segments])
+    if not accumulate:
+        last_segment = np.full(width * height, -1)
+        np.maximum.at(last_segment, np.ravel_multi_index((ys, xs), (width, height)), segments)
+        covered = last_segment >= 0
+        grid = np.zeros(width * height)
+        grid[covered] = values[last_segment[covered]]
+        grid = grid.reshape(width, height)
+    return grid, quantity
+
+def create_cells(grid_dim):
     cells = [[Cell() for _ in range(grid_dim[0])] for _ in range(grid_dim[1])]
 
     increase_width = 1 / grid_dim[0] 
@@ -592,71 +1013,124 @@ def assign_agents_to_cells(csv_data, grid_dim, duration):
             multiplier_h = (i * increase_height, (i+1) * increase_height)
             cells[i][j].set_multiplier(multiplier_w, multiplier_h)
             cells[i][j].coordinates = (i, j)
+    return cells
 
-    min_time = duration[0]
-    max_time = duration[1]
-
-    for agent_trajectory in csv_data.values():
-        # Start and end are based on the entire trajectory for now
-        start_point = agent_trajectory.iloc[1]
-        end_point = agent_trajectory.iloc[-1]
-
-        filtered_trajectory = agent_trajectory.loc[(agent_trajectory['frame'] >= min_time) & (agent_trajectory['frame'] <= max_time)]
-
-        new_agent = Agent()
-        last_cell = None
-        for i, row in filtered_trajectory.iterrows():
-            frame = row['frame']
-            # TODO: Maybe fliP Z
-            point = (row['pos_x'], 1 - row['pos_z'])
-            cell_coordinates = point_to_cell(point, grid_dim)
-            current_cell = cells[cell_coordinates[1]][cell_coordinates[0]]
-
-            if i == 0:
-                last_cell = cell_coordinates
-                current_cell.add_agent(new_agent)          
-
-            # Check if the current agent is already added to the cell
-            if last_cell != cell_coordinates:
-                new_agent = Agent()
-                current_cell.add_agent(new_agent)
+def assign_agents_to_cells(csv_data, grid_dim, duration):
+    return WindowBuckets(csv_data, grid_dim, [duration]).cells(0)
 
-            last_cell = cell_coordinates
+def generate(path, name, frame_interval, row_step, separation, framerate, n_processes, image_cache=None, window_stride=None, window_lengths=None):
+    agent_dict, windows, max_frame = generate_stream(path, name, frame_interval, row_step, separation, framerate, n_processes, image_cache, window_stride, window_lengths)
 
-            cell_norm_x = normalize(point[0], current_cell.multiplier_width[0], current_cell.multiplier_width[1] , 0, 1)
-            cell_norm_z = normalize(point[1], current_cell.multiplier_height[0], current_cell.multiplier_height[1] , 0, 1)
-            cell_point = (cell_norm_x, cell_norm_z)
+    model_images = []
+    model_masking = []
+    for images, masking in windows:
+        model_images.extend(images)
+        model_masking.extend(masking)
 
-            current_cell.agents[-1].add_trajectory_point(cell_point, frame, row['speed'], row['velocity_x'], row['velocity_z'])
-    return cells
+    return agent_dict, model_images, model_masking, max_frame
 
-def generate(path, name, frame_interval, row_step, separation, framerate, n_processes):
+def generate_stream(path, name, frame_interval, row_step, separation, framerate, n_processes, image_cache=None, window_stride=None, window_lengths=None):
+    """Same as generate, but the images and masks are returned as a generator of (images, masking)
+    per window that builds them as it is consumed. The windows are the ones window_ranges lists."""
     csv_directory = current_file_dir + path
-    csv_data, csv_data_norm, env_dict, agent_dict = read_csv_files_and_env_json(csv_directory, row_step, framerate, separation)
+    csv_data, csv_data_norm, env_dict, agent_dict = read_csv_files_and_env_json(csv_directory, row_step, framerate, separation, n_processes)
 
     env_grid = np.zeros((height * separation[1], width * separation[0]))
     built_env_grid(env_grid, env_dict)
 
-    frame_dict = create_frame_dict(csv_data_norm)
-
     timestep = 1 / framerate
     max_timestep = max(df['frame'].max() for df in csv_data.values())
     max_frame = int(max_timestep / timestep)
 
-    frame_cells = {}
-    for frame in tqdm(range(0, max_frame, frame_interval), position=0, leave=True, desc="Reading: "):
-        start_time = frame * timestep
-        end_time = (frame + frame_interval) * timestep
-    
-        cells = assign_agents_to_cells(csv_data_norm, separation, (start_time, end_time))
-        frame_cells[frame] = cells
-   
-    model_images = []
-    model_masking = []
-    for i, cells in tqdm(enumerate(frame_cells.values()), total=len(frame_cells.values()), position=0, leave=True, desc="Generating: "):
-        create_cells_grid(cells, env_grid, model_images, model_masking)
-      
-    return agent_dict, model_images, model_masking, max_frame
+    window_frames = window_ranges(max_frame, frame_interval, window_stride, window_lengths)
+    windows = [(start * timestep, end * timestep) for start, end in window_frames]
+    buckets = WindowBuckets(csv_data_norm, separation, windows)
+    velocity = VelocityAccumulator(csv_data_norm, separation)
+
+    seed = None
+    if image_cache is not None:
+        seed = hashlib.sha256(json.dumps(raster_parameters(separation, frame_interval, row_step)).encode())
+        seed.update(env_grid.tobytes())
+
+    return agent_dict, window_images(buckets, velocity, env_grid, n_processes, image_cache, seed), max_frame
+
+def window_ranges(max_frame, frame_interval, window_stride=None, window_lengths=None):
+    """Returns the (start, end) frames of every window, length by length. Each length in window_lengths
+    ([frame_interval] by default) gets windows starting every window_stride frames, or every length
+    frames when no stride is given, so by default windows are consecutive blocks of frame_interval."""
+    return [(frame, frame + length) for length in (window_lengths or [frame_interval])
+            for frame in range(0, max_frame, window_stride or length)]
+
+def raster_parameters(separation, frame_interval, row_step):
+    """Everything besides the points of a window and env_grid that the images of the window depend on."""
+    return {
+        "version": 2,  # Bump when the way the images are drawn changes
+        "separation": list(separation),
+        "frame_interval": frame_interval,
+        "row_step": row_step,
+        "size": [width, height],
+        "max_speed_norm": max_speed_norm,
+        "group_agents": Cell.group_agents.__defaults__,
+        "cluster_agents": Cell.cluster_agents.__defaults__,
+        "draw_clusters": draw_clusters.__defaults__,
+        "fill_polygon": fill_polygon.__defaults__,
+    }
+
+def window_images(buckets, velocity, env_grid, n_processes, image_cache=None, seed=None):
+    """Yields the images and masks of every window in order, built across n_processes when above 1.
+
+    At most two windows per process are in flight, so a slow consumer also holds back the workers
+    instead of letting finished windows pile up. With an image_cache, windows whose key built from
+    seed is cached are loaded instead of built, and built windows are added to it.
+    """
+    progress = tqdm(total=len(buckets), position=0, leave=True, desc="Generating: ")
+    keys = [buckets.window_key(window, seed) for window in range(len(buckets))] if image_cache is not None else None
+
+    def cached(window):
+        return image_cache.get(keys[window]) if image_cache is not None else None
+
+    def built(window, result):
+        if image_cache is not None:
+            image_cache.put(keys[window], *result)
+        return result
+
+    if n_processes > 1 and len(buckets) > 1:
+        # Workers receive the buckets, velocity sums and env_grid once through the initializer, tasks are window indices
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=init_window_worker, initargs=(buckets, velocity, env_grid)) as executor:
+            pending = deque()
+            for window in range(len(buckets)):
+                result = cached(window)
+                future = executor.submit(generate_window, window) if result is None else None
+                pending.append((window, result, future))
+                if len(pending) >= 2 * n_processes:
+                    window, result, future = pending.popleft()
+                    yield result if future is None else built(window, future.result())
+                    progress.update()
+            while pending:
+                window, result, future = pending.popleft()
+                yield result if future is None else built(window, future.result())
+                progress.update()
+    else:
+        init_window_worker(buckets, velocity, env_grid)
+        for window in range(len(buckets)):
+            result = cached(window)
+            yield result if result is not None else built(window, generate_window(window))
+            progress.update()
+    progress.close()
+
+def init_window_worker(buckets, velocity, env_grid):
+    """Keeps the read-only data every window is built from in the process."""
+    global window_buckets, window_velocity, window_env_grid
+    window_buckets = buckets
+    window_velocity = velocity
+    window_env_grid = env_grid
+
+def generate_window(window):
+    """Builds the images and masks of every cell of a window, in the order create_cells_grid visits them."""
+    images, masking = [], []
+    velocity_grids = window_velocity.grids(*window_buckets.windows[window])
+    create_cells_grid(window_buckets.cells(window), window_env_grid, images, masking, velocity_grids)
+    return images, masking
 
 def built_env_grid(env_grid, env_dict):
     width = env_grid.shape[1]
@@ -674,14 +1148,18 @@ def built_env_grid(env_grid, env_dict):
         x_min_range, x_max_range = np.clip(x - range_x, 0, width), np.clip(x + range_x + 1, 0, width)
         env_grid[z_min_range:z_max_range, x_min_range:x_max_range] = env_object
 
-def create_cells_grid(cells, env_grid, model_images, model_masking):
+def create_cells_grid(cells, env_grid, model_images, model_masking, velocity_grids=None):
     rows = len(cells)
     cols = len(cells[0])
 
     for row_idx, row in enumerate(cells):
         for col_idx, cell in enumerate(row):
             model_image = np.zeros((width, height, 5)).astype(np.float32)
-            cell.build_velocity_grid()
+            if velocity_grids is None:
+                cell.build_velocity_grid()
+            else:
+                cell.velocity_x_grid = velocity_grids[0][row_idx][col_idx]
+                cell.velocity_z_grid = velocity_grids[1][row_idx][col_idx]
             cell.build_dfg_grid()
             cell.build_groups_grid(env_grid)
             cell.build_connect_grid()
@@ -739,14 +1217,16 @@ def cluster_profiles(profiles, threshold=0.125, samples=1):
 
     return distinct_profiles
 
-def assign_profiles(profiles, separation, frame_interval, max_frame):
+def assign_profiles(profiles, separation, frame_interval, max_frame, window_frames=None):
     default_profile = (1.0, 0, 0, 0.75)
     final_profiles = {}
+    if window_frames is None:
+        window_frames = window_ranges(max_frame, frame_interval)
 
     profile_index = 0
-    for frame_index in range(0, max_frame, frame_interval):
+    for start_frame, end_frame in window_frames:
         frame_profiles = {}
-        frame_key = str(frame_index) + "_" + str(frame_index + frame_interval)
+        frame_key = str(start_frame) + "_" + str(end_frame)
         for row in range(separation[1]):
             for col in range(separation[0]): 
                 area_key = str(row) + "_" + str(col)
@@ -796,7 +1276,7 @@ def make_grid_image(images, rows, columns, frame, path):
         x_pos = x * (img_width + 1)
         
         grid[y_pos:y_pos+img_height, x_pos:x_pos+img_width] = img
-        np.savez_compressed(path + name, img)
+        np.savez_compressed(path + name, **encode_sample(img, sample_encoding))
 
     # Fill with white lines. Assuming images are normalized between 0 and 1.
     for i in range(1, rows):
@@ -833,7 +1313,27 @@ def save_image_grid(path, images, rows, columns, frame):
         plt.savefig(path + ".jpg", bbox_inches='tight', dpi=500)
         plt.close()
 
-def save_reference_images(path, images, separation, frame_interval):
+def window_name(window_frames, i, frame_interval):
+    """Name of the reference images of window i: its start frame, or start_end when it is not frame_interval long."""
+    if window_frames is None:
+        return str(i * frame_interval)
+    start_frame, end_frame = window_frames[i]
+    if end_frame - start_frame == frame_interval:
+        return str(start_frame)
+    return str(start_frame) + "_" + str(end_frame)
+
+def saved_reference_windows(path, windows, separation, frame_interval, window_frames=None):
+    """Passes the (images, masking) of every window through, saving each window's reference images
+    on the way like save_reference_images does for all of them at once."""
+    path = current_file_dir + path.replace("Trajectories", "Images")
+    os.makedirs(path, exist_ok=True)
+
+    for i, (images, masking) in enumerate(windows):
+        frame = window_name(window_frames, i, frame_interval)
+        save_image_grid(path + frame, images, separation[1], separation[0], frame)
+        yield images, masking
+
+def save_reference_images(path, images, separation, frame_interval, window_frames=None):
     num_images_per_grid = separation[1] * separation[0] 
     num_grids = len(images) // num_images_per_grid
 
@@ -842,11 +1342,14 @@ def save_reference_images(path, images, separation, frame_interval):
 
     for i in range(num_grids):
         batch = images[i*num_images_per_grid:(i+1)*num_images_per_grid]
-        frame = str(i * frame_interval)
+        frame = window_name(window_frames, i, frame_interval)
         frame_path = path + frame
         save_image_grid(frame_path, batch, separation[1], separation[0], frame)
 
 if __name__ ==  '__main__':
+    # Imported here only, it loads the model and torch, which the spawned worker processes have no use for
+    from inference import predict, predict_stream
+
     name = "Zara"
     path = r"\\PATH-TO-DATASET\\" + name + "\\"
     frame_interval = 250 # Number of frames per image
@@ -858,14 +1361,27 @@ if __name__ ==  '__main__':
     separation = get_grid_separation(video_width, video_height, grid_multiplier)
     thicken_radius = 2
     n_processes = 16 # Number of processes to use for parallel processing. Adjust based on the machine.
+    streaming = True # Predict while the images are generated instead of keeping all of them in memory
+    batch_size = 256 # Number of images per forward pass when streaming
+    max_buffered_bytes = 2 ** 30 # Memory ceiling for the batches waiting for the model when streaming
+    image_cache = WindowImageCache(os.path.join(current_file_dir, "Data", "Cache", "Images"), 4 * 2 ** 30) # Set to None to always rebuild the images
+    window_stride = None # Frames between window starts, below frame_interval windows overlap. None for consecutive windows
+    window_lengths = None # Several window lengths in frames to generate at once. None for frame_interval only
 
     start = time.time()
     print("Running using: " + path)
-    # Generate images from trajectories
-    agent_dict, model_images, model_masking, max_frame = generate(path, name, frame_interval, row_step, separation, video_framerate, n_processes)
-    predicted_profiles = predict(model_images, model_masking)
-    final_profiles, profile_clusters = assign_profiles(predicted_profiles, separation, frame_interval, max_frame)
+    if streaming:
+        agent_dict, windows, max_frame = generate_stream(path, name, frame_interval, row_step, separation, video_framerate, n_processes, image_cache, window_stride, window_lengths)
+        window_frames = window_ranges(max_frame, frame_interval, window_stride, window_lengths)
+        windows = saved_reference_windows(path, windows, separation, frame_interval, window_frames)
+        predicted_profiles = predict_stream(windows, batch_size, max_buffered_bytes)
+    else:
+        # Generate images from trajectories
+        agent_dict, model_images, model_masking, max_frame = generate(path, name, frame_interval, row_step, separation, video_framerate, n_processes, image_cache, window_stride, window_lengths)
+        window_frames = window_ranges(max_frame, frame_interval, window_stride, window_lengths)
+        predicted_profiles = predict(model_images, model_masking)
+        save_reference_images(path, model_images, separation, frame_interval, window_frames)
+    final_profiles, profile_clusters = assign_profiles(predicted_profiles, separation, frame_interval, max_frame, window_frames)
 
     generate_json(path, final_profiles, profile_clusters, separation, frame_interval, video_framerate, agent_dict)
-    save_reference_images(path, model_images, separation, frame_interval)
     print((time.time() - start) / 60.0)
\ No newline at end of file
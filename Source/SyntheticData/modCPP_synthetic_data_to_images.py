@@ -11,13 +11,25 @@ from matplotlib.path import Path
 import matplotlib.pyplot as plt
 from scipy.spatial import ConvexHull, Delaunay
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor
-import uuid
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import itertools
+import argparse
+import importlib.util
+
+# encode_sample is shared with the dataloader, which reads the samples back. The file is loaded by
+# its path, putting the training Models/ directory on sys.path would let it shadow other modules
+encoding_spec = importlib.util.spec_from_file_location("sample_encoding", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "MPACT_Framework", "MPACT_Model", "Models", "sample_encoding.py"))
+encoding_module = importlib.util.module_from_spec(encoding_spec)
+encoding_spec.loader.exec_module(encoding_module)
+encode_sample = encoding_module.encode_sample
 
 # ------------GLOBAL PARAMETERS STARTS------------ 
 directory_path = './IN-PATH-TRAJECTORIES/'
 output_images_path = './OUT-PATH-IMAGES/Images/'
-output_labels_file_path = './OUT-PATH-LABELS/labels.json'
+output_shards_path = './OUT-PATH-IMAGES/Shards/' # Used instead of output_images_path when packing with --shard-size
+output_labels_file_path = './OUT-PATH-LABELS/labels.npy' # Label index compiled from the manifest, memory-mapped by the dataloader
+manifest_file_path = './OUT-PATH-LABELS/manifest.jsonl' # Append-only log of the finished runs and their labels
 width, height = 64, 64
 channels = 5 # 1:Vx, 2:Vz, 3:DFG, 4:GROUP, 5:CONNECT
 norm_factor = 6.5
@@ -31,21 +43,25 @@ max_neighbors = 5
 max_speed = 2.5
 max_env_distance = 15
 max_dfg_distance = 5
+sample_encoding = "dense" # "dense", "sparse" or "sparse_uint8", see encode_sample
 # -------------GLOBAL PARAMETERS ENDS-------------
 
 # ----------------CLASSES STARTS------------------
 class Agent:
+    __slots__ = ('spawn_pos', 'goal_pos', 'timesteps', 'positions', 'speeds', 'stop_group_intervals',
+                 'stop_poi_durations', 'group_poi_ratio', 'velocity_x', 'velocity_z')
+
     def __init__(self, spawn_pos, goal_pos):
         self.spawn_pos = spawn_pos
         self.goal_pos = goal_pos
-        self.timesteps = []
-        self.positions = []
-        self.speeds = []
+        self.timesteps = np.empty(0)
+        self.positions = np.empty((0, 2))  # One (x, z) row per point
+        self.speeds = np.empty(0)
         self.stop_group_intervals = []
         self.stop_poi_durations = []
         self.group_poi_ratio = 1
-        self.velocity_x = []
-        self.velocity_z = []
+        self.velocity_x = np.empty(0)
+        self.velocity_z = np.empty(0)
 
     def add_position(self, timestep_local, position, speed):
         if len(self.positions) > 0:
@@ -53,34 +69,45 @@ class Agent:
             delta_z = position[1] - self.positions[-1][1]
             v_x = delta_x / timestep
             v_z = delta_z / timestep 
-            self.velocity_x.append(v_x)
-            self.velocity_z.append(v_z)
+            self.velocity_x = np.append(self.velocity_x, v_x)
+            self.velocity_z = np.append(self.velocity_z, v_z)
         else:
-            self.velocity_x.append(0)
-            self.velocity_z.append(0)
-
-        self.timesteps.append(timestep_local)
-        self.positions.append(position)
-        self.speeds.append(speed)
+            self.velocity_x = np.append(self.velocity_x, 0)
+            self.velocity_z = np.append(self.velocity_z, 0)
+
+        self.timesteps = np.append(self.timesteps, timestep_local)
+        self.positions = np.append(self.positions, [position], axis=0)
+        self.speeds = np.append(self.speeds, speed)
+
+    def set_trajectory(self, timesteps, positions, speeds):
+        """Bulk equivalent of calling add_position for every row of the arrays."""
+        self.timesteps = np.asarray(timesteps, dtype=np.float64)
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        self.speeds = np.asarray(speeds, dtype=np.float64)
+        # Velocity from the previous position, 0 for the first one
+        velocity = np.zeros_like(self.positions)
+        velocity[1:] = np.diff(self.positions, axis=0) / timestep
+        self.velocity_x = velocity[:, 0].copy()
+        self.velocity_z = velocity[:, 1].copy()
 
     def path_distance(self):
         return euclidean_distance(self.spawn_pos, self.goal_pos)
 
     def detect_stationary(self):
-        for current_time, current_agent_position, speed in zip(self.timesteps, self.positions, self.speeds):
-            if current_time <= 3:
-                continue
-            if speed < 0.5:
-                if len(self.stop_group_intervals) == 0:
-                    self.stop_group_intervals.append([current_time - timestep, current_time, current_agent_position])
-                else:
-                    self.stop_group_intervals[-1][1] = current_time
-                    self.stop_group_intervals[-1][2] = current_agent_position
-                    if euclidean_distance(current_agent_position, self.stop_group_intervals[-1][2]) >= 4:
-                        self.stop_group_intervals.append([current_time - timestep, current_time, current_agent_position])
-            elif len(self.stop_group_intervals) > 0:
-                self.stop_group_intervals[-1][1] = current_time
-                self.stop_group_intervals[-1][2] = current_agent_position
+        # Points in the first 3 seconds are left out
+        index = np.flatnonzero(~(self.timesteps <= 3))
+        if len(index) == 0:
+            return
+
+        if len(self.stop_group_intervals) == 0:
+            stopped = np.flatnonzero(self.speeds[index] < 0.5)
+            if len(stopped) == 0:
+                return
+            current_time = float(self.timesteps[index[stopped[0]]])
+            self.stop_group_intervals.append([current_time - timestep, current_time, None])
+        # An interval is never closed, every later point extends it up to the last one
+        self.stop_group_intervals[-1][1] = float(self.timesteps[index[-1]])
+        self.stop_group_intervals[-1][2] = tuple(self.positions[index[-1]].tolist())
 
     def compute_deviation(self, position):
         x1, y1 = self.spawn_pos
@@ -96,8 +123,19 @@ class Agent:
         return abs(A*x0 + B*y0 + C) / (A**2 + B**2)**0.5
 
     def average_deviation(self):
-        total_deviation = sum(self.compute_deviation(pos) for pos in self.positions)
-        return total_deviation / len(self.positions)
+        """Mean of compute_deviation over all positions."""
+        x1, y1 = self.spawn_pos
+        x2, y2 = self.goal_pos
+        A = y2 - y1
+        B = x1 - x2
+
+        if A < 0.0001 and B < 0.0001:
+            return 0.0
+
+        C = (x2*y1) - (x1*y2)
+        deviations = np.abs(A*self.positions[:, 0] + B*self.positions[:, 1] + C) / (A**2 + B**2)**0.5
+        # Summed in order, as the per position loop did
+        return float(np.cumsum(deviations)[-1]) / len(self.positions)
 
     def create_dfg_line(self, n=1):
         line_points = create_line_between_points(self.spawn_pos, self.goal_pos)
@@ -106,56 +144,105 @@ class Agent:
 class Cluster:
     def __init__(self, agents):
         self.agents = agents
+        self.positions, self.valid = self.pad_positions()
         self.interpersonal_distances = self.calculate_interpersonal_distances()
         self.center_of_mass_trajectory = self.calculate_center_of_mass_trajectory()
 
-    def euclidean_distance(self, pos1, pos2):
-        return np.linalg.norm(np.array(pos1) - np.array(pos2))
+    def pad_positions(self):
+        """Stacks the members' positions into an (agents, T, 2) array padded with zeros, T being the
+        longest trajectory, along with an (agents, T) mask of the timesteps each agent has a position."""
+        lengths = np.array([len(agent.positions) for agent in self.agents])
+        positions = np.zeros((len(self.agents), lengths.max(), 2))
+        for i, agent in enumerate(self.agents):
+            positions[i, :lengths[i]] = agent.positions
+        valid = np.arange(lengths.max()) < lengths[:, None]
+        return positions, valid
 
     def calculate_interpersonal_distances(self):
-        distances_per_timestep = []
-
-        max_timesteps = max([len(agent.positions) for agent in self.agents])
-        for timestep in range(max_timesteps):
-            total_distance = 0
-            num_pairs = 0
+        # Pairs i < j in the order the agents are listed, so the per timestep sums add up as before
+        first, second = np.triu_indices(len(self.agents), 1)
+        diff = self.positions[first] - self.positions[second]
+        # Same dot product np.linalg.norm takes for a single pair
+        distances = np.sqrt(np.matmul(diff[..., None, :], diff[..., :, None])[..., 0, 0])
+        valid_pairs = self.valid[first] & self.valid[second]
 
-            # Gather agents that have a position at this timestep
-            valid_agents = [agent for agent in self.agents if len(agent.positions) > timestep]
-
-            for i, agent1 in enumerate(valid_agents):
-                for j, agent2 in enumerate(valid_agents):
-                    if i < j:  # Avoid comparing an agent with itself and double counting
-                        total_distance += self.euclidean_distance(agent1.positions[timestep], agent2.positions[timestep])
-                        num_pairs += 1
-
-            avg_distance = total_distance / num_pairs if num_pairs != 0 else 0
-            distances_per_timestep.append(avg_distance)
-
-        return distances_per_timestep
+        total_distance = np.add.reduce(np.where(valid_pairs, distances, 0), axis=0)
+        num_pairs = valid_pairs.sum(axis=0)
+        return np.divide(total_distance, num_pairs, out=np.zeros_like(total_distance), where=num_pairs != 0)
 
     def calculate_center_of_mass_trajectory(self):
-        trajectory = []
-
-        max_timesteps = max([len(agent.positions) for agent in self.agents])
-        for timestep in range(max_timesteps):
-            sum_x, sum_y = 0, 0
-            num_valid_agents = 0  # Number of agents that have a position at this timestep
-
-            for agent in self.agents:
-                if len(agent.positions) > timestep:
-                    sum_x += agent.positions[timestep][0]
-                    sum_y += agent.positions[timestep][1]
-                    num_valid_agents += 1
-
-            if num_valid_agents > 0:
-                center_of_mass = (sum_x / num_valid_agents, sum_y / num_valid_agents)
-                trajectory.append(center_of_mass)
+        # Every timestep up to the longest trajectory has at least one agent, so the count is never 0
+        num_valid_agents = self.valid.sum(axis=0)
+        return np.add.reduce(self.positions, axis=0) / num_valid_agents[:, None]
+
+
+class ShardWriter:
+    """Packs samples into shards of at most shard_size rows instead of one file per sample.
+
+    A shard is shard_<n>.npy, the (rows, width, height, channels) float16 images, next to
+    shard_<n>_index.npy, the (key, weights) row of each image. With a sparse sample_encoding the
+    images are instead the (index, value) pairs of encode_sample, all rows one after the other in
+    shard_<n>_pairs.npy, and each index row also holds the start and stop of its pairs.
+    Both files are written aside and renamed, the index last, so a shard whose index exists is complete. The samples of one run never
+    straddle two shards, and add/flush return the manifest entries of the runs a finished shard
+    holds, so the manifest only records runs whose images are on disk. Samples are only held until
+    the shard they go in is flushed, so at most one shard is in memory.
+    """
+    def __init__(self, path, shard_size, resume=False):
+        self.path = path
+        self.shard_size = shard_size
+        os.makedirs(path, exist_ok=True)
+        finished = sorted(glob.glob(os.path.join(path, "shard_*_index.npy")))
+        if not resume:
+            for name in glob.glob(os.path.join(path, "shard_*")):
+                os.remove(name)
+            finished = []
+        self.shard = int(os.path.basename(finished[-1]).split("_")[1]) + 1 if finished else 0
+        self.keys, self.weights, self.images, self.entries = [], [], [], []
+
+    def add(self, item, labels, samples):
+        entries = []
+        if self.keys and len(self.keys) + len(samples) > self.shard_size:
+            entries = self.flush()
+        for key, img in samples.items():
+            self.keys.append(key)
+            self.weights.append(labels[key])
+            self.images.append(img)
+        self.entries.append({"item": item, "labels": labels})
+        if len(self.keys) >= self.shard_size:
+            entries += self.flush()
+        return entries
+
+    def flush(self):
+        if self.keys:
+            name = os.path.join(self.path, "shard_%05d" % self.shard)
+            fields = [('key', 'U%d' % max(len(key) for key in self.keys)), ('weights', np.float32, 4)]
+            if "indices" in self.images[0]:
+                counts = [len(sample["indices"]) for sample in self.images]
+                data = np.empty(sum(counts), dtype=[('index', self.images[0]["indices"].dtype), ('value', self.images[0]["values"].dtype)])
+                data['index'] = np.concatenate([sample["indices"] for sample in self.images])
+                data['value'] = np.concatenate([sample["values"] for sample in self.images])
+                data_name = name + "_pairs.npy"
+                fields += [('start', np.int64), ('stop', np.int64)]
             else:
-                # No agents have positions for this timestep; append None or a placeholder
-                trajectory.append(None)
-
-        return trajectory
+                data = np.stack([sample["arr_0"] for sample in self.images])
+                data_name = name + ".npy"
+            # The samples now live in data, let them go before the shard is written
+            self.images = []
+            index = np.empty(len(self.keys), dtype=fields)
+            index['key'] = self.keys
+            index['weights'] = self.weights
+            if "start" in index.dtype.names:
+                index['stop'] = np.cumsum(counts)
+                index['start'] = index['stop'] - counts
+            for data, target in ((data, data_name), (index, name + "_index.npy")):
+                with open(target + ".tmp", "wb") as shard_file:
+                    np.save(shard_file, data)
+                os.replace(target + ".tmp", target)
+            self.shard += 1
+        entries = self.entries
+        self.keys, self.weights, self.images, self.entries = [], [], [], []
+        return entries
 # -----------------CLASSES ENDS-------------------
 
 #--------------UTIL FUNCTIONS STARTS--------------
@@ -203,6 +290,77 @@ def create_line_between_points(pos_a, pos_b):
     line_points = bresenham_line(point_a_x, point_a_z, point_b_x, point_b_z)
     return line_points
 
+def bresenham_lines(x1, y1, x2, y2):
+    """Vectorised bresenham_line for N segments at once.
+
+    Every still unfinished segment advances one step per iteration, so the loop runs
+    max(dx, dy) + 1 times instead of once per pixel. Returns the segment index, x and y
+    of every generated point, in the same per-segment order as bresenham_line.
+    """
+    x, y = np.array(x1, dtype=np.int64), np.array(y1, dtype=np.int64)
+    x2, y2 = np.asarray(x2, dtype=np.int64), np.asarray(y2, dtype=np.int64)
+    dx = np.abs(x2 - x)
+    dy = np.abs(y2 - y)
+    sx = np.where(x < x2, 1, -1)
+    sy = np.where(y < y2, 1, -1)
+    err = dx - dy
+
+    segments, points_x, points_y = [], [], []
+    active = np.arange(len(x))
+    while active.size:
+        segments.append(active)
+        points_x.append(x[active])
+        points_y.append(y[active])
+        active = active[(x[active] != x2[active]) | (y[active] != y2[active])]
+        e2 = 2 * err[active]
+        step_x = active[e2 > -dy[active]]
+        step_y = active[e2 < dx[active]]
+        err[step_x] -= dy[step_x]
+        x[step_x] += sx[step_x]
+        err[step_y] += dx[step_y]
+        y[step_y] += sy[step_y]
+
+    if not segments:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    segments = np.concatenate(segments)
+    order = np.argsort(segments, kind='stable')
+    return segments[order], np.concatenate(points_x)[order], np.concatenate(points_y)[order]
+
+def create_lines_between_points(pos_a, pos_b):
+    """Vectorised create_line_between_points for N segments given as (N, 2) positions.
+    Returns the segment index, x and z of every pixel."""
+    pos_a = np.reshape(np.asarray(pos_a, dtype=np.float64), (-1, 2))
+    pos_b = np.reshape(np.asarray(pos_b, dtype=np.float64), (-1, 2))
+    point_a_x = np.clip(np.floor((pos_a[:, 0] + norm_factor) * scale_factor), 0, width - 1)
+    point_a_z = np.clip(np.floor((pos_a[:, 1] + norm_factor) * scale_factor), 0, height - 1)
+    point_b_x = np.clip(np.floor((pos_b[:, 0] + norm_factor) * scale_factor), 0, width - 1)
+    point_b_z = np.clip(np.floor((pos_b[:, 1] + norm_factor) * scale_factor), 0, height - 1)
+    return bresenham_lines(point_a_x, point_a_z, point_b_x, point_b_z)
+
+def rasterize_lines(pos_a, pos_b, values, accumulate=True, weights=None):
+    """Draws N segments with one value each. Returns the per-pixel sum of the values and
+    the number of segments covering every pixel.
+
+    A segment with weight k counts as if it was drawn k times. With accumulate=False a
+    pixel holds the value of the last segment drawn over it instead of the sum.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    segments, xs, zs = create_lines_between_points(pos_a, pos_b)
+    if weights is None:
+        grid, quantity = accumulate_pixels(xs, zs, values[segments])
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        grid, _ = accumulate_pixels(xs, zs, values[segments] * weights[segments])
+        quantity, _ = accumulate_pixels(xs, zs, weights[segments])
+    if not accumulate:
+        last_segment = np.full(width * height, -1)
+        np.maximum.at(last_segment, np.ravel_multi_index((xs, zs), (width, height)), segments)
+        covered = last_segment >= 0
+        grid = np.zeros(width * height)
+        grid[covered] = values[last_segment[covered]]
+        grid = grid.reshape(width, height)
+    return grid, quantity
+
 def is_inside(p, hull):
     """
     Checks if point p is inside the convex hull.
@@ -230,61 +388,87 @@ def get_enclosed_points(points, grid_size=1):
     return [tuple(point) for point in enclosed_points]
 
 def fill_polygon(grid, groups, max_duration=18):
-    grid_quantity = np.zeros((width, height))
+    pos_a, pos_b, values = [], [], []
     for group in groups:
         agent_positions = group["points"] # Now, we get positions from the group object
         duration = group["duration"]  # We get the duration from the group object
 
-        if len(agent_positions) > 2:
-            for i in range(len(agent_positions) - 1):
-                line_points = create_line_between_points(agent_positions[i], agent_positions[i+1])
-                if line_points is None:
-                     continue
-                for point in line_points:
-                    x, y = point
-                    # Normalize the distance for this point
-                    grid[x, y] += np.clip(duration / max_duration, 0, 1)
-                    grid_quantity[x, y] += 1
-        elif len(agent_positions) == 2:
-            line_points = create_line_between_points(agent_positions[0], agent_positions[1])
-            if line_points is None:
-                    continue
-            for point in line_points:
-                x, y = point
-                # Normalize the distance for this point
-                grid[x, y] += np.clip(duration / max_duration, 0, 1)
-                grid_quantity[x, y] += 1
+        # Consecutive points are joined, which for two points is a single line
+        if len(agent_positions) >= 2:
+            pos_a.extend(agent_positions[:-1])
+            pos_b.extend(agent_positions[1:])
+            values.extend([np.clip(duration / max_duration, 0, 1)] * (len(agent_positions) - 1))
 
+    lines, grid_quantity = rasterize_lines(pos_a, pos_b, values)
+    grid += lines
     mask = grid_quantity > 0
     grid[mask] = grid[mask] / grid_quantity[mask]
     return grid
 
 def cluster_agents(agents, threshold=3.0, traj_similarity = 0.6, timestep_threshold=2):
-    def similar_trajectory(agent1, agent2):
-        similar_points = 0
-        for t1, pos1 in enumerate(agent1.positions):
-            for t2, pos2 in enumerate(agent2.positions):
-                if abs(agent1.timesteps[t1] - agent2.timesteps[t2]) <= timestep_threshold:
-                    if euclidean_distance(pos1, pos2) < threshold:
-                        similar_points += 1
-                        break
-        percentage_similarity = similar_points / len(agent1.positions)
-        return percentage_similarity > traj_similarity
-
+    # One cluster per seed agent that has at least one similar agent, keyed by the seed's index
     clusters = {}
-    cluster_id = 0
-    for agent1 in agents:
-        for agent2 in agents:
-            if agent1 == agent2:
-                continue
-            if similar_trajectory(agent1, agent2):
-                if cluster_id not in clusters:
-                    clusters[cluster_id] = set()
-                clusters[cluster_id].add(agent1)
-                clusters[cluster_id].add(agent2)
-        cluster_id += 1
+    for cluster_id, other in similar_trajectories(agents, threshold, traj_similarity, timestep_threshold):
+        if cluster_id not in clusters:
+            clusters[cluster_id] = {agents[cluster_id]}
+        clusters[cluster_id].add(agents[other])
     return clusters
 
+def similar_trajectories(agents, threshold, traj_similarity, timestep_threshold):
+    """Returns the (agent, other_agent) index pairs, in agent order, where more than traj_similarity
+    of the agent's points have a point of the other agent closer than threshold and at most
+    timestep_threshold apart in time.
+
+    Points are hashed into a grid of threshold-sized buckets and sorted by (bucket, time), so the
+    candidates of a point are found with searchsorted over the time windows of the 3x3
+    neighbouring buckets instead of comparing every pair of points of every pair of agents.
+    """
+    if len(agents) < 2 or threshold <= 0:
+        return []
+    lengths = np.array([len(agent.positions) for agent in agents])
+    owners = np.repeat(np.arange(len(agents)), lengths)
+    points = np.concatenate([np.reshape(agent.positions, (-1, 2)) for agent in agents]).astype(np.float64)
+    times = np.concatenate([np.asarray(agent.timesteps, dtype=np.float64) for agent in agents])
+
+    # Grid hash with a one bucket border so that neighbour offsets never wrap around
+    bucket_x = np.floor(points[:, 0] / threshold).astype(np.int64)
+    bucket_z = np.floor(points[:, 1] / threshold).astype(np.int64)
+    bucket_x -= bucket_x.min() - 1
+    bucket_z -= bucket_z.min() - 1
+    rows = bucket_z.max() + 2
+    buckets = bucket_x * rows + bucket_z
+
+    # One sorted key per point: its bucket, then its time inside the bucket
+    span = times.max() - times.min() + 2 * timestep_threshold + 1
+    margin = 1e-9 * span
+    keys = buckets * span + (times - times.min())
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    candidates_p, candidates_q = [], []
+    for offset in (-rows - 1, -rows, -rows + 1, -1, 0, 1, rows - 1, rows, rows + 1):
+        centre = (buckets + offset) * span + (times - times.min())
+        lo = np.searchsorted(sorted_keys, centre - timestep_threshold - margin, side='left')
+        hi = np.searchsorted(sorted_keys, centre + timestep_threshold + margin, side='right')
+        counts = hi - lo
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        candidates_p.append(np.repeat(np.arange(len(points)), counts))
+        candidates_q.append(order[starts + np.arange(counts.sum())])
+    p = np.concatenate(candidates_p)
+    q = np.concatenate(candidates_q)
+
+    # Exact tests, as in the pairwise comparison they replace
+    distances = np.sqrt((points[q, 0] - points[p, 0]) ** 2 + (points[q, 1] - points[p, 1]) ** 2)
+    matches = (owners[p] != owners[q]) & (distances < threshold) & (np.abs(times[p] - times[q]) <= timestep_threshold)
+    p, other = p[matches], owners[q[matches]]
+
+    # A point counts once per other agent, however many of its points are close
+    matched_points = np.unique(p * len(agents) + other)
+    pair_keys, similar_points = np.unique(owners[matched_points // len(agents)] * len(agents) + matched_points % len(agents), return_counts=True)
+    agent, other_agent = pair_keys // len(agents), pair_keys % len(agents)
+    similar = similar_points / lengths[agent] > traj_similarity
+    return list(zip(agent[similar].tolist(), other_agent[similar].tolist()))
+
 def overlapping_time(interval1, interval2):
     # Returns the overlapping duration between two intervals
     return max(0, min(interval1[1], interval2[1]) - max(interval1[0], interval2[0]))
@@ -293,35 +477,65 @@ def is_within_distance(point1, point2, distance):
     # Check if two points are within a certain distance
     return ((point1[0] - point2[0])**2 + (point1[1] - point2[1])**2)**0.5 <= distance
 
+def stop_interval_contacts(agents, group_distance):
+    """Returns (agent_index, interval_index, other_agent_index, other_interval_index, overlap_duration)
+    for every pair of stop intervals of two different agents that overlap in time and lie within
+    group_distance, ordered as the pairwise comparison over agents and intervals visited them.
+
+    Intervals are swept in start order and kept in a spatial hash of group_distance-sized buckets
+    while they are still open, so only concurrent intervals in neighbouring buckets are compared.
+    """
+    intervals = [(i, k, interval) for i, agent in enumerate(agents) for k, interval in enumerate(agent.stop_group_intervals)]
+    bucket_size = group_distance if group_distance > 0 else 1
+    open_intervals = {}
+    contacts = []
+    for i, k, interval in sorted(intervals, key=lambda entry: entry[2][0]):
+        bucket_x = math.floor(interval[2][0] / bucket_size)
+        bucket_z = math.floor(interval[2][1] / bucket_size)
+        for neighbour in ((bucket_x + dx, bucket_z + dz) for dx in (-1, 0, 1) for dz in (-1, 0, 1)):
+            bucket = open_intervals.get(neighbour)
+            if not bucket:
+                continue
+            # Intervals that ended before this one starts cannot overlap any of the later ones either
+            bucket[:] = [entry for entry in bucket if entry[2][1] > interval[0]]
+            for j, l, other_interval in bucket:
+                if i == j:
+                    continue
+                overlap_duration = overlapping_time(interval, other_interval)
+                if overlap_duration > 0 and is_within_distance(interval[2], other_interval[2], group_distance):
+                    contacts.append((i, k, j, l, overlap_duration) if i < j else (j, l, i, k, overlap_duration))
+        open_intervals.setdefault((bucket_x, bucket_z), []).append((i, k, interval))
+    contacts.sort(key=lambda contact: contact[:4])
+    return contacts
+
 def group_agents(agents):
     groups = []
-
-    for i, agent in enumerate(agents):
-        for interval in agent.stop_group_intervals:
-            for j, other_agent in enumerate(agents):
-                # Avoid checking the agent against itself and avoid checking pairs more than once
-                if i < j:
-                    for other_interval in other_agent.stop_group_intervals:
-                        overlap_duration = overlapping_time(interval, other_interval)
-                        if overlap_duration > 0 and is_within_distance(interval[2], other_interval[2], group_distance):
-
-                            agent_group = next((g for g in groups if agent in g["agents"]), None)
-                            other_agent_group = next((g for g in groups if other_agent in g["agents"]), None)
-
-                            if not agent_group and not other_agent_group:  # Both agents are not in any group
-                                groups.append({
-                                    "agents": {agent, other_agent},
-                                    "points": [interval[2], other_interval[2]],
-                                    "duration": overlap_duration
-                                })
-
-                            elif agent_group and not other_agent_group:  # Only agent is in a group
-                                agent_group["agents"].add(other_agent)
-                                agent_group["points"].append(other_interval[2])
-
-                            elif not agent_group and other_agent_group:  # Only other_agent is in a group
-                                other_agent_group["agents"].add(agent)
-                                other_agent_group["points"].append(interval[2])
+    membership = {}  # Agent -> its group, groups are never merged so this is fixed once set
+
+    for i, k, j, l, overlap_duration in stop_interval_contacts(agents, group_distance):
+        agent, other_agent = agents[i], agents[j]
+        interval = agent.stop_group_intervals[k]
+        other_interval = other_agent.stop_group_intervals[l]
+        agent_group = membership.get(agent)
+        other_agent_group = membership.get(other_agent)
+
+        if not agent_group and not other_agent_group:  # Both agents are not in any group
+            groups.append({
+                "agents": {agent, other_agent},
+                "points": [interval[2], other_interval[2]],
+                "duration": overlap_duration
+            })
+            membership[agent] = membership[other_agent] = groups[-1]
+
+        elif agent_group and not other_agent_group:  # Only agent is in a group
+            agent_group["agents"].add(other_agent)
+            agent_group["points"].append(other_interval[2])
+            membership[other_agent] = agent_group
+
+        elif not agent_group and other_agent_group:  # Only other_agent is in a group
+            other_agent_group["agents"].add(agent)
+            other_agent_group["points"].append(interval[2])
+            membership[agent] = other_agent_group
 
     # Convert agent sets to lists and remove duplicate points
     for group in groups:
@@ -330,35 +544,29 @@ def group_agents(agents):
 
     return groups
 
-def draw_clusters(clusters, img):
-    img_quantity = np.zeros((width, height))
+def draw_clusters(clusters, img, multiplicities=None):
     if len(clusters) == 0:
         return
+    if multiplicities is None:
+        multiplicities = [1] * len(clusters)
 
     max_distance = group_distance
     min_distance = 0
 
-    for cluster in clusters:
+    pos_a, pos_b, values, weights = [], [], [], []
+    for cluster, multiplicity in zip(clusters, multiplicities):
+        # Consecutive centers of mass are joined, each segment valued by the distance at its start
         trajectory = cluster.center_of_mass_trajectory
-        distances = cluster.interpersonal_distances
-
-        for i in range(len(trajectory) - 1):
-            start_point = trajectory[i]
-            end_point = trajectory[i + 1]
-
-            if start_point is not None and end_point is not None:
-                # Get all points for the line segment between the two points
-                line_points = create_line_between_points(start_point, end_point)
-                if line_points is None:
-                    continue
-
-                for point in line_points:
-                    x, z = point
-                    # Normalize the distance for this point
-                    distances = np.clip(distances, 0, max_distance)
-                    value = (distances[i] - min_distance) / (max_distance - min_distance)
-                    img[x][z] += normalize((1 - value), 0, 1, 0.1, 1)
-                    img_quantity[x][z] += 1
+        distances = np.clip(cluster.interpersonal_distances[:-1], 0, max_distance)
+        value = (distances - min_distance) / (max_distance - min_distance)  # Normalize the distance for every segment
+        pos_a.append(trajectory[:-1])
+        pos_b.append(trajectory[1:])
+        values.append(normalize((1 - value), 0, 1, 0.1, 1))
+        weights.append(np.full(len(trajectory) - 1, multiplicity))
+
+    pos_a, pos_b, values, weights = (np.concatenate(part) for part in (pos_a, pos_b, values, weights))
+    lines, img_quantity = rasterize_lines(pos_a, pos_b, values, weights=weights)
+    img += lines
     mask = img_quantity > 0
     img[mask] = img[mask] / img_quantity[mask]
     return img
@@ -393,6 +601,36 @@ def normalize(value, min_value, max_value, new_min, new_max):
     normalized = ((value - min_value) / (max_value - min_value)) * (new_max - new_min) + new_min
     return normalized
 
+def normalize_velocity(velocity):
+    """Maps velocities from [-1, 1] to [-0.5, 0.5] and nudges near-zero values by 0.05 so they stay visible."""
+    velocity_norm = normalize(velocity, -1, 1, -0.5, 0.5)
+    return np.where(np.abs(velocity_norm) < 0.01, velocity_norm + 0.05, velocity_norm)
+
+def accumulate_pixels(rows, cols, values=None, shape=(width, height)):
+    """Scatter-adds values onto the pixels (rows, cols) of a grid. Returns the per-pixel sums and counts."""
+    flat = np.ravel_multi_index((rows, cols), shape)
+    size = shape[0] * shape[1]
+    counts = np.bincount(flat, minlength=size).reshape(shape).astype(np.float64)
+    if values is None:
+        return counts, counts
+    sums = np.bincount(flat, weights=values, minlength=size).reshape(shape)
+    return sums, counts
+
+def rasterize_velocity(rows, cols, velocity_x, velocity_z):
+    """Builds both velocity channels from whole point arrays: the mean normalised velocity per pixel
+    on a 0.5 background. Velocities are expected in [-1, 1] and points outside the grid are dropped."""
+    inside = (rows >= 0) & (cols >= 0) & (rows < width) & (cols < height)
+    rows, cols = rows[inside], cols[inside]
+    sum_x, quantity = accumulate_pixels(rows, cols, normalize_velocity(velocity_x[inside]))
+    sum_z, _ = accumulate_pixels(rows, cols, normalize_velocity(velocity_z[inside]))
+
+    velocity_x_grid = np.zeros((width, height)) + 0.5
+    velocity_z_grid = np.zeros((width, height)) + 0.5
+    mask = quantity > 0
+    velocity_x_grid[mask] += sum_x[mask] / quantity[mask]
+    velocity_z_grid[mask] += sum_z[mask] / quantity[mask]
+    return velocity_x_grid, velocity_z_grid
+
 def print_grid_image(img, name, weights):
     title = "Weights: (Goal: " + format(weights[0], '.2f') + ", Group: " + format(weights[1], '.2f') + ", Interact: " + format(weights[2], '.2f') + ", Conn: " + format(weights[3], '.2f') + ")"   
     # Split the channels
@@ -470,7 +708,7 @@ def add_connect(input_data, connect, channel):
 def add_poi(input_data, poi, channel):
     input_data[:,:,channel] = poi
 
-def create_image(env_grid, velocity_x_grid, velocity_z_grid, dfg_grid, group_grid, connect_grid, poi_grid, weights, filename, local_labels):
+def create_image(env_grid, velocity_x_grid, velocity_z_grid, dfg_grid, group_grid, connect_grid, poi_grid, weights, filename, local_labels, samples=None):
     input_data = np.zeros((width, height, 5), np.float16)
 
     add_velocity_x(input_data, velocity_x_grid, 0)
@@ -487,12 +725,17 @@ def create_image(env_grid, velocity_x_grid, velocity_z_grid, dfg_grid, group_gri
                 filename_temp = filename + "_" + str(x) + "_" + str(y)
                 name = output_images_path + filename_temp
                 local_labels[filename_temp] = weights
-                np.savez_compressed(name, img_out)
+                sample = encode_sample(img_out, sample_encoding)
+                if samples is not None:
+                    samples[filename_temp] = sample
+                else:
+                    np.savez_compressed(name, **sample)
                 #print_grid_image(img_out, name, weights)
                 #save_demo_image(img_out, name)    
 
-def process_item(item):
+def process_item(item, packed=False):
     local_labels = {}
+    samples = {} if packed else None
 
     with open(directory_path + item + "/env.json") as json_file:
         data_json = json.load(json_file)
@@ -524,86 +767,51 @@ def process_item(item):
     agents = []
     for file_name in csv_files:
         csv_data = pd.read_csv(file_name, names=['timestep', 'pos_x', 'pos_z', 'a', 'b'], sep=';', skiprows=1)
-        
+        # Columns: timestep, pos_x, pos_z
+        smoothed_data = csv_data[['timestep', 'pos_x', 'pos_z']].to_numpy(np.float64)
+
         poly_order = 4 # Polynomial order, usually between 2 and 6
         window_size = 191  # Must be an odd integer
-        csv_size = len(csv_data)
+        csv_size = len(smoothed_data)
         if csv_size >= window_size:
-            smoothed_timestep = savgol_filter(csv_data['timestep'], window_size, poly_order)
-            smoothed_pos_x = savgol_filter(csv_data['pos_x'], window_size, poly_order)
-            smoothed_pos_z = savgol_filter(csv_data['pos_z'], window_size, poly_order)
-        else:
-            smoothed_timestep = csv_data['timestep'].values
-            smoothed_pos_x = csv_data['pos_x'].values
-            smoothed_pos_z = csv_data['pos_z'].values
-
-        smoothed_data = pd.DataFrame({'timestep': smoothed_timestep, 'pos_x': smoothed_pos_x, 'pos_z': smoothed_pos_z})
+            # One call per column, filtering all of them along axis 0 differs in the last bits, which is
+            # enough to move points across thresholds such as the 3 seconds in detect_stationary
+            smoothed_data = np.stack([savgol_filter(column, window_size, poly_order) for column in smoothed_data.T], axis=1)
 
-        second_row = smoothed_data.iloc[1]
-        last_row = smoothed_data.iloc[-1]
-        spawn_pos = (float(second_row['pos_x']), float(second_row['pos_z']))
-        goal_pos = (float(last_row['pos_x']), float(last_row['pos_z']))
+        spawn_pos = tuple(smoothed_data[1, 1:].tolist())
+        goal_pos = tuple(smoothed_data[-1, 1:].tolist())
 
         agent = Agent(spawn_pos, goal_pos)
 
-        for row_index, row in smoothed_data.iloc[1:].iterrows():
-            if row_index % step == 0:
-                timestep = float(row['timestep']) 
-                x_raw = float(row['pos_x'])
-                z_raw = float(row['pos_z'])
-                current_agent_position = (x_raw, z_raw)
-
-                # Calculate speed                
-                if len(agent.positions) == 0:
-                    speed = 1
-                else:
-                    dis = euclidean_distance(agent.positions[-1], (x_raw, z_raw))
-                    speed = calculate_speed(dis)
-                speed = np.clip(speed, 0, max_speed)
-
-                agent.add_position(timestep, current_agent_position, speed)
+        # Every step-th row, skipping the first one
+        sampled_data = smoothed_data[step::step]
+        positions = sampled_data[:, 1:]
+        # Speed from the distance to the previous position, 1 for the first one
+        speeds = np.ones(len(positions))
+        speeds[1:] = calculate_speed(np.sqrt(np.sum(np.diff(positions, axis=0) ** 2, axis=1)))
+        speeds = np.clip(speeds, 0, max_speed)
 
+        agent.set_trajectory(sampled_data[:, 0], positions, speeds)
         agents.append(agent)        
 
     # CALCULATE VELOCITY GRID
-    velocity_x_grid = np.zeros((width, height)) + 0.5
-    velocity_z_grid = np.zeros((width, height)) + 0.5
-    velocity_grid_quantity = np.zeros((width, height))
-    for agent in agents:
-        for i, point in enumerate(agent.positions):
-            x = math.floor((point[0] + norm_factor) * scale_factor)
-            y = math.floor((point[1] + norm_factor) * scale_factor)
-            if x < 0 or y < 0 or x >= width or y >= height:
-                continue 
-            v_x = agent.velocity_x[i] / max_speed
-            v_z = agent.velocity_z[i] / max_speed
-            v_x_norm = normalize(v_x, -1, 1, -0.5, 0.5)
-            v_z_norm = normalize(v_z, -1, 1, -0.5, 0.5)
-            if abs(v_x_norm) < 0.01:
-                v_x_norm += 0.05
-            if abs(v_z_norm) < 0.01:
-                v_z_norm += 0.05    
-            velocity_x_grid[x, y] += v_x_norm
-            velocity_z_grid[x, y] += v_z_norm
-            velocity_grid_quantity[x, y] += 1
-    mask = velocity_grid_quantity > 0
-    velocity_x_grid[mask] = ((velocity_x_grid[mask] - 0.5) / velocity_grid_quantity[mask]) + 0.5
-    velocity_z_grid[mask] = ((velocity_z_grid[mask] - 0.5) / velocity_grid_quantity[mask]) + 0.5
+    points = np.concatenate([np.empty((0, 2))] + [np.reshape(agent.positions, (-1, 2)) for agent in agents])
+    velocity_x = np.concatenate([np.empty(0)] + [np.asarray(agent.velocity_x, dtype=np.float64) for agent in agents])
+    velocity_z = np.concatenate([np.empty(0)] + [np.asarray(agent.velocity_z, dtype=np.float64) for agent in agents])
+    x = np.floor((points[:, 0] + norm_factor) * scale_factor).astype(np.int64)
+    y = np.floor((points[:, 1] + norm_factor) * scale_factor).astype(np.int64)
+    velocity_x_grid, velocity_z_grid = rasterize_velocity(x, y, velocity_x / max_speed, velocity_z / max_speed)
 
     # CALCULATE DFG GRID
-    dfg_grid = np.zeros((width, height))
-    dfg_grid_quantity = np.zeros((width, height))
+    spawn = [agent.spawn_pos for agent in agents]
+    goal = [agent.goal_pos for agent in agents]
+    dfg_values = []
     for agent in agents:
-        line_points = agent.create_dfg_line()
         avg_dfg = agent.average_deviation() / max_dfg_distance
         path_dfg = agent.path_distance() / max_env_distance
         dfg = (0.3 * avg_dfg + 0.7 * path_dfg) / 2
-        if line_points is None:
-                    continue
-        for point in line_points:
-            x, y = point
-            dfg_grid[x, y] = np.clip(1 - dfg, 0, 1)
-            dfg_grid_quantity[x, y] += 1
+        dfg_values.append(np.clip(1 - dfg, 0, 1))
+    dfg_grid, dfg_grid_quantity = rasterize_lines(spawn, goal, dfg_values, accumulate=False)
     mask = dfg_grid_quantity > 0
     dfg_grid[mask] = dfg_grid[mask] / dfg_grid_quantity[mask]
 
@@ -613,45 +821,114 @@ def process_item(item):
     groups = group_agents(agents)
     group_grid = np.zeros((width, height))
     fill_polygon(group_grid, groups)
-    for x in range(env_grid.shape[0]):
-        for y in range(env_grid.shape[1]):
-            if env_grid[x, y] > 0:
-                group_grid[x, y] = env_grid[x, y]
+    env_mask = env_grid > 0
+    group_grid[env_mask] = env_grid[env_mask]
 
     # CALCULATE CONNECT GRID
     connect_grid = np.zeros((width, height))
     clusters = cluster_agents(agents, threshold=2.5)
-    clusters_objects = [Cluster(cluster) for cluster in clusters.values()]
-    draw_clusters(clusters_objects, connect_grid)
+    # Seeds of the same group yield identical clusters: build each once and draw it as often as it was found
+    multiplicities = {}
+    for cluster in clusters.values():
+        key = frozenset(cluster)
+        multiplicities[key] = multiplicities.get(key, 0) + 1
+    clusters_objects = [Cluster(cluster) for cluster in multiplicities]
+    draw_clusters(clusters_objects, connect_grid, multiplicities=list(multiplicities.values()))
 
     # CALCULATE DPOI GRID
     poi_grid = np.zeros((width, height))
 
-    unique_id = uuid.uuid4().hex
-    create_image(env_grid, velocity_x_grid, velocity_z_grid, dfg_grid, group_grid, connect_grid, poi_grid, weights, "img_" + item + str(unique_id), local_labels)
-    return local_labels
+    # Named after the run only, so processing it again overwrites its images
+    create_image(env_grid, velocity_x_grid, velocity_z_grid, dfg_grid, group_grid, connect_grid, poi_grid, weights, "img_" + item, local_labels, samples)
+    # Packed samples go back to the main process, which owns the shards
+    return local_labels, samples
+
+def read_manifest(path):
+    """Yields (item, labels) for every run recorded as finished in the manifest.
+
+    A last line cut short by an interrupted run is removed from the file, so the entries appended
+    next start on a line of their own.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as manifest:
+        complete = manifest.seek(0, os.SEEK_END)
+        while complete > 0:
+            manifest.seek(complete - 1)
+            if manifest.read(1) == b"\n":
+                break
+            complete -= 1
+        manifest.truncate(complete)
+        manifest.seek(0)
+        for line in manifest:
+            entry = json.loads(line)
+            yield entry["item"], entry["labels"]
+
+def compile_label_index(manifest_path, index_path):
+    """Writes the labels of the manifest as one .npy of (key, weights) rows sorted by key.
+
+    The file can be memory-mapped and searched with np.searchsorted, so the dataloader workers
+    never parse the labels themselves.
+    """
+    keys, weights = [], []
+    for _, labels in read_manifest(manifest_path):
+        for key, value_tuple in labels.items():
+            keys.append(key)
+            weights.append(value_tuple)
+    key_length = max((len(key) for key in keys), default=1)
+    index = np.empty(len(keys), dtype=[('key', 'U%d' % key_length), ('weights', np.float32, 4)])
+    keys = np.asarray(keys, dtype=index.dtype['key'])
+    order = np.argsort(keys)
+    index['key'] = keys[order]
+    index['weights'] = np.asarray(weights, dtype=np.float32).reshape(-1, 4)[order]
+    # Written aside and renamed so a reader never maps a half-written index
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "wb") as index_file:
+        np.save(index_file, index)
+    os.replace(temp_path, index_path)
+
 #----------IMAGE CREATION FUNCTIONS ENDS----------
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds the training images and labels from the Unity runs.")
+    parser.add_argument("--resume", action="store_true", help="only process the runs missing from the manifest")
+    parser.add_argument("--shard-size", type=int, default=None, help="pack the images into shards of this many samples instead of one file each")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(output_labels_file_path), exist_ok=True)
+    os.makedirs(os.path.dirname(manifest_file_path), exist_ok=True)
+    done = set(item for item, _ in read_manifest(manifest_file_path)) if args.resume else set()
+    writer = ShardWriter(output_shards_path, args.shard_size, resume=args.resume) if args.shard_size else None
+
     # Get a list of all the items (files and directories) in the directory
-    items = os.listdir(directory_path)
+    items = [item for item in os.listdir(directory_path) if item not in done]
     random.shuffle(items)
     parts = items[:]
 
-    with ProcessPoolExecutor(max_workers=12) as executor:
-        labels = list(tqdm(executor.map(process_item, parts), total=len(parts)))
-        
-    merged_data = {}
-    for d in labels:
-        for key, value_tuple in d.items():
-            merged_data[key] = {
-                "wg": value_tuple[0],
-                "wgr": value_tuple[1],
-                "wi": value_tuple[2],
-                "wc": value_tuple[3]
-            }
-    os.makedirs(os.path.dirname(output_labels_file_path), exist_ok=True)
-
-    # Write the JSON file
-    with open(output_labels_file_path, 'w') as json_file:
-        json.dump(merged_data, json_file, indent=4)
\ No newline at end of file
+    # Every run is recorded as soon as it finishes, so an interrupted run keeps what it did. At most
+    # two runs per worker are in flight and each is dropped once recorded, so the labels and images
+    # never pile up in memory
+    max_workers = 12
+    queue = iter(parts)
+    pending = {}
+    with open(manifest_file_path, "a" if args.resume else "w") as manifest, ProcessPoolExecutor(max_workers=max_workers) as executor, tqdm(total=len(parts)) as progress:
+        while True:
+            for item in itertools.islice(queue, 2 * max_workers - len(pending)):
+                pending[executor.submit(process_item, item, writer is not None)] = item
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                item = pending.pop(future)
+                labels, samples = future.result()
+                entries = writer.add(item, labels, samples) if writer else [{"item": item, "labels": labels}]
+                # The writer holds the samples until their shard is flushed, the run itself is not needed anymore
+                del labels, samples
+                for entry in entries:
+                    manifest.write(json.dumps(entry) + "\n")
+                manifest.flush()
+                progress.update()
+        for entry in (writer.flush() if writer else []):
+            manifest.write(json.dumps(entry) + "\n")
+
+    compile_label_index(manifest_file_path, output_labels_file_path)